@@ -3,6 +3,7 @@
 from __future__ import print_function
 from __future__ import absolute_import
 from .containers.build import BuildContainer
+from .persist_cache import PersistCache, DEFAULT_SEED_BRANCH
 
 
 class Builder(object):
@@ -12,6 +13,9 @@ class Builder(object):
         self.image = image
         self.project = project
         self.ssh_dir = config.get('ssh_dir', None)
+        self.persist_cache = PersistCache(
+            project.shared, config.get('persist_cache_bytes'),
+            config.get('persist_seed_branch', DEFAULT_SEED_BRANCH))
         self.container = None
         self.result_image = None
         self.keep_build_container = False
@@ -23,11 +27,12 @@ class Builder(object):
 
     def build(self):
         container = BuildContainer(self.project, self.image, self.builder,
-                                   self.ssh_dir)
+                                   self.ssh_dir, self.persist_cache)
         self.container = container
 
         print('Building...')
-        container.start()
+        with self.persist_cache.using(container.persist_entries):
+            container.start()
         if container.success:
             self.result_image = container.commit(self.project)
         else:
@@ -2,6 +2,8 @@
 
 from __future__ import print_function
 import argparse
+import copy
+import multiprocessing
 import sys
 import os
 from os import path
@@ -10,9 +12,12 @@ from .builders import Builder, BuildException
 from .dockerfile import get_dockerfile
 from .config import Config
 from .project import Project
-from .images import Image, get_tag_with_hash, get_repository_name
+from .images import ImageCache, BUILD_DEPS_REPOSITORY, \
+    DEFAULT_IMAGE_CACHE_BYTES
 from .packages import PackageManager
 from .notifications import NotificationManager
+from .scheduler import JobScheduler, JobCycleError
+from .utils import lock_wait_seconds, LOCK_POLL_INTERVAL
 from os.path import expanduser
 
 
@@ -55,6 +60,7 @@ class Command(object):
         return {
             "build": self.build,
             "dist": self.dist,
+            "dist-all": self.dist_all,
         }.get(command, command_not_found)
 
     def _gen_notification_context(self):
@@ -111,6 +117,25 @@ class Command(object):
         self._set_package_manager_from_args(args)
         return args
 
+    def parse_dist_all_args(self, args):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("git_url")
+        parser.add_argument("branch")
+        parser.add_argument("--codename", help="e.g. unstable, stable")
+        parser.add_argument("--or-just-build", action='store_true')
+        parser.add_argument("--skip-tests", action='store_true')
+        parser.add_argument("--keep-build-container", action='store_true')
+        parser.add_argument("-w", "--workers", type=int,
+                            default=self.config.defaults.get(
+                                "workers", multiprocessing.cpu_count()),
+                            help="number of jobs to run at once")
+        parser.set_defaults(package=None, repo=None, job=None)
+        args = parser.parse_args(args)
+        self._set_project_from_args(args)
+        if not args.codename:
+            args.codename = self.project.branch_codenames.get(args.branch)
+        return args
+
     def build(self, args):
         args = self.parse_build_args(args)
         return self._build(args)
@@ -119,28 +144,37 @@ class Command(object):
         if self.project.current_job.dockerfile is not None:
             raise NotImplementedError("build the dockerfile")
         dockerfile = get_dockerfile(self.project)
-        tag = get_tag_with_hash(self.project.source.current_branch,
-                                dockerfile.hash())
-        repository = get_repository_name(self.project, "build-deps")
-        image = Image(repository, tag)
-        image.create_image(dockerfile)
-
-        builder = Builder(self.config.defaults, image,
-                          self.project.current_job,
-                          self.project.current_job.build_type, self.project)
-        builder.keep_build_container = args.keep_build_container
+        image_cache = ImageCache(
+            BUILD_DEPS_REPOSITORY, self.home,
+            self.config.defaults.get("build_deps_cache_bytes",
+                                     DEFAULT_IMAGE_CACHE_BYTES))
+        tag = dockerfile.hash()
+        image = image_cache.get(tag)
         try:
-            builder.build()
-            self.notifier.run_hook("build-success",
-                                   self._gen_notification_context())
-            return builder
-        except BuildException as ex:
-            builder.remove()
-            self.notifier.run_hook("build-failure",
-                                   self._gen_notification_context())
-            self.die("failed to build project {}; "
-                     "build exited with '{}'".format(self.project.name,
-                                                     ex.status))
+            image.create_image(dockerfile,
+                               self.config.defaults.get("build_cache_dir"),
+                               self.config.defaults.get("build_builder"))
+            image_cache.evict(keep=[tag])
+
+            builder = Builder(self.config.defaults, image,
+                              self.project.current_job,
+                              self.project.current_job.build_type,
+                              self.project)
+            builder.keep_build_container = args.keep_build_container
+            try:
+                builder.build()
+                self.notifier.run_hook("build-success",
+                                       self._gen_notification_context())
+                return builder
+            except BuildException as ex:
+                builder.remove()
+                self.notifier.run_hook("build-failure",
+                                       self._gen_notification_context())
+                self.die("failed to build project {}; "
+                         "build exited with '{}'".format(self.project.name,
+                                                         ex.status))
+        finally:
+            image_cache.release(tag)
 
     def _package(self, *args, **kwargs):
         self.package_manager.package(*args, **kwargs)
@@ -149,6 +183,43 @@ class Command(object):
 
     def dist(self, args):
         args = self.parse_package_args(args)
+        self._dist(args)
+
+    def _for_job(self, args, job_name):
+        # Each job gets its own project and package manager, so jobs can be
+        # run on separate threads without treading on each other.
+        command = copy.copy(self)
+        args = argparse.Namespace(**vars(args))
+        args.job = job_name
+        command._set_project_from_args(args)
+        command._set_package_manager_from_args(args)
+        return command, args
+
+    def dist_all(self, args):
+        args = self.parse_dist_all_args(args)
+        try:
+            scheduler = JobScheduler(self.project.jobs, args.workers)
+        except JobCycleError as e:
+            self.die(e.message)
+
+        def run_job(job_name):
+            command, job_args = self._for_job(args, job_name)
+            command._dist(job_args)
+
+        results = scheduler.run(run_job)
+        failed = sorted(k for k, v in results.iteritems() if v is not None)
+        for job_name in sorted(results):
+            print("{}: {}".format(job_name,
+                                  "failed" if job_name in failed else "done"))
+        waits = sorted(lock_wait_seconds.iteritems(), key=lambda w: -w[1])
+        for fn, seconds in waits:
+            if seconds >= LOCK_POLL_INTERVAL:
+                print("waited {:.1f}s for lock {}".format(seconds, fn))
+        if failed:
+            self.die("{} of {} jobs failed: {}".format(
+                len(failed), len(results), ", ".join(failed)))
+
+    def _dist(self, args):
         try:
             if self.project.skip_all:
                 if self.project.num_commits == 0:
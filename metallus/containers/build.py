@@ -1,18 +1,22 @@
 # coding: utf-8
 
-from .container import Container, CONTAINER_BASE_DIR
+from .container import Container, CONTAINER_BASE_DIR, CONTAINER_OVERLAY
 import os
 import pkg_resources
-from metallus.utils import sha256
+from metallus.persist_cache import NORMALISED_STAMP_SUFFIX
+from metallus.utils import sha256, fresh_directory
 from os.path import expanduser
 
 CONTAINER_SCRIPTS_DIR = "/scripts"
+PERSIST_SYNC = "sync"
+PERSIST_MOUNT = "mount"
 
 
 class BuildContainer(Container):
-    def __init__(self, project, image, builder, ssh_dir):
+    def __init__(self, project, image, builder, ssh_dir, persist_cache):
         self.user = 'root'
         self.project = project
+        self.persist_cache = persist_cache
         self.image = image
         self.start_in = self.project.current_job.start_in
         self.persisted_volumes = []
@@ -72,19 +76,35 @@ class BuildContainer(Container):
             'mkdir -p "{}" "{}" "{}"'.format(self.home, self.source, self.tmp))
         self.cmds.append(
             'source "{}"'.format(self.container_script('persist')))
-        self.cmds.append('sync "{}/" "{}"'.format(self.tmp, self.source))
+        if self.project.source_overlay:
+            self.cmds.append('source "{}"'.format(
+                self.container_script('source-overlay')))
+            self.cmds.append('mount_source')
+        else:
+            self.cmds.append('sync "{}/" "{}"'.format(self.tmp, self.source))
 
-        # Copy persisted folders in before build
+        # Persisted folders are either mounted where the build expects
+        # them, or copied in before the build and back out after
+        mount = self.project.current_job.persist_mode == PERSIST_MOUNT
         for hash, folder, path, host_path in self.persisted_volumes:
-            self.cmds.append('sync "{0}/" "{1}"'.format(host_path, folder))
+            if mount:
+                self.cmds.append('mount_persisted "{0}" "{1}"'.format(
+                    host_path, folder))
+            else:
+                self.cmds.append('sync_persisted "{0}/" "{1}"'.format(
+                    host_path, folder))
 
         # run builder
         self.cmds.append(
             '/bin/bash < "{}"'.format(self.container_script(self.builder)))
 
-        # Sync persisted folders back to host
         for hash, folder, path, host_path in self.persisted_volumes:
-            self.cmds.append('sync "{0}/" "{1}"'.format(folder, host_path))
+            if mount:
+                self.cmds.append('unmount_persisted "{0}" "{1}"'.format(
+                    host_path, folder))
+            else:
+                self.cmds.append('sync_persisted "{0}/" "{1}"'.format(
+                    folder, host_path))
 
     def _set_volumes(self):
         self._create_persistent_volumes()
@@ -92,6 +112,11 @@ class BuildContainer(Container):
             self._get_volume(self.scripts_dir, CONTAINER_SCRIPTS_DIR))
         self.volumes.append(
             self._get_volume(self.project.source.path, self.tmp))
+        if self.project.source_overlay:
+            # Each build starts from a clean checkout
+            fresh_directory(self.project.source_overlay)
+            self.volumes.append(self._get_volume(
+                self.project.source_overlay, CONTAINER_OVERLAY))
         if self.ssh_dir is None:
             self.volumes.append(self._get_volume('/root/.ssh'))
         else:
@@ -99,18 +124,21 @@ class BuildContainer(Container):
                 self._get_volume(expanduser(self.ssh_dir), '/root/.ssh'))
 
     def _create_persistent_volumes(self):
+        self.persist_entries = []
         for folder in self.project.current_job.persist:
             hash = sha256(folder)
-            path = os.path.join(self.project.shared,
-                                self.project.source.current_branch,
-                                self.project.current_job.name,
-                                hash)
-            if not os.path.isdir(path):
-                os.makedirs(path)
+            key, path = self.persist_cache.entry(
+                self.project.source.current_branch,
+                self.project.current_job.name, folder)
+            self.persist_entries.append((key, path))
             host_path = os.path.join(self.shared, hash)
             t = hash, folder, path, host_path
             self.persisted_volumes.append(t)
             self.volumes.append(self._get_volume(path, host_path))
+            # Its normalisation stamp, beside it (see scripts/persist)
+            self.volumes.append(self._get_volume(
+                path + NORMALISED_STAMP_SUFFIX,
+                host_path + NORMALISED_STAMP_SUFFIX))
 
     def _get_volume(self, src, dest=None):
         if dest is None:
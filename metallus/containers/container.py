@@ -2,24 +2,17 @@
 
 from __future__ import print_function
 
-from distutils import dir_util
-import errno
-import os
-import os.path
-import shutil
-import tarfile
-import threading
-import time
-
 from ..images import Image, get_repository_name
+from .diff_readers import get_diff_reader
 from ..utils import new_docker_client
 
 CONTAINER_BASE_DIR = '/.metallus'
 CONTAINER_HOME = '{}/build'.format(CONTAINER_BASE_DIR)
 CONTAINER_TEMP = '{}/tmp'.format(CONTAINER_BASE_DIR)
 CONTAINER_SOURCE = '{}/src'.format(CONTAINER_HOME)
-
-COPY_THREADS = 10
+CONTAINER_PACKAGES = '{}/packages'.format(CONTAINER_BASE_DIR)
+# Where the build's changes to an overlay-mounted source are kept
+CONTAINER_OVERLAY = '{}/overlay'.format(CONTAINER_BASE_DIR)
 
 
 class Container(object):
@@ -41,7 +34,6 @@ class Container(object):
         self.docker_default_directories = \
             ['dev', '.metallus', '.wh..wh.aufs', '.wh..wh.plnk',
              '.wh..wh.orph', 'tmp']
-        self.directory = None
         self.status = None
 
     def start(self):
@@ -64,10 +56,6 @@ class Container(object):
         self.status = int(
             self.client.inspect_container(self.container)['State']['ExitCode'])
 
-        root_dir = next(v for k, v in self.client.info()['DriverStatus']
-                        if k == "Root Dir")
-        self.directory = os.path.join(root_dir, 'diff', self.container_id)
-
     def stop(self):
         self.client.stop(self.container_id)
         self.client.kill(self.container_id)
@@ -76,66 +64,11 @@ class Container(object):
         self.client.remove_container(self.container_id, force=True)
 
     def copy_diff(self, dest):
-        if self._has_aufs_diff:
-            self._copy_from_aufs(dest)
-        else:
-            self._copy_from_docker_api(dest)
-
-    def _copy_from_docker_api(self, dest):
-        print("Copying package data from container through Docker...")
-
-        def copy_thread(files):
-            for f in files:
-                self._copy_file_from_docker_api(f, dest)
-
-        time_started = time.time()
-        threads = []
-        diff = list(self.diff())
-        if len(diff) >= (COPY_THREADS * 5):
-            n = max(1, len(diff) // COPY_THREADS)
-            for i in xrange(0, len(diff), n):
-                t = threading.Thread(
-                    target=copy_thread, args=(diff[i:i+n],))
-                t.start()
-                threads.append(t)
-            for t in threads:
-                t.join()
-        else:
-            copy_thread(diff)
-
-        print("Time taken: {}s".format(time.time() - time_started))
-
-    def _copy_from_aufs(self, dest):
-        print("Copying package data from container through AUFS...")
-
-        dir_util.copy_tree(self.directory, dest, preserve_symlinks=True)
-        for d in self.docker_default_directories:
-            path = os.path.join(dest, d)
-            if os.path.exists(path):
-                os.chmod(path, 0777)
-                if os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
-
-    def _copy_file_from_docker_api(self, src, dest):
-        if not os.path.isabs(src):
-            raise Exception("src must be an absolute path")
-
-        path = os.path.normpath(dest + src)
-        dest_dir = os.path.dirname(path)
-        try:
-            os.makedirs(dest_dir)
-        except OSError as e:
-            if not e.errno == errno.EEXIST:
-                raise
-
-        with self.client.copy(self.container_id, src) as src_f, \
-                tarfile.open(fileobj=src_f, mode='r|') as tar:
-            tar.extractall(dest_dir)
-
-        if os.path.exists(path):
-            os.chmod(path, 0o777)
+        get_diff_reader(self).copy(dest)
+
+    def copy_path(self, src, dest):
+        """Copies what the container has written under src into dest."""
+        get_diff_reader(self).copy_path(src, dest)
 
     def diff(self):
         prev = ''
@@ -157,7 +90,3 @@ class Container(object):
     @property
     def success(self):
         return self.status == 0
-
-    @property
-    def _has_aufs_diff(self):
-        return self.directory and os.path.isdir(self.directory)
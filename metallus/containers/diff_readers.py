@@ -0,0 +1,398 @@
+# coding: utf-8
+
+"""
+Ways of copying the files a container has changed into a package directory.
+
+Each reader works with a particular storage driver, reading the container's
+layer straight off disk where it can. get_diff_reader picks the first one in
+DIFF_READERS that can be used for a container; copying through the Docker
+API always works, so it comes last.
+"""
+
+from __future__ import print_function
+
+import collections
+from contextlib import closing
+import errno
+import fcntl
+import os
+import os.path
+import Queue
+import shutil
+import stat
+import sys
+import tarfile
+import threading
+import time
+
+from docker.errors import APIError
+
+COPY_THREADS = 10
+COPY_BUFFER_SIZE = 1024 * 1024
+# ioctl to make a copy-on-write clone of a file, on filesystems that can
+FICLONE = 0x40049409
+AUFS_WHITEOUT_PREFIX = ".wh."
+# Diffs with at least this many top-level paths are copied from a single
+# export of the container rather than a request per path
+EXPORT_DIFF_THRESHOLD = 200
+
+
+def _clone_file(src, dest):
+    """
+    Hard links src to dest, or failing that makes a reflink copy, or failing
+    that copies its bytes. Returns how it was done.
+    """
+    try:
+        os.link(src, dest)
+        return 'linked'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+        try:
+            fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+            how = 'cloned'
+        except IOError:
+            shutil.copyfileobj(src_f, dest_f, COPY_BUFFER_SIZE)
+            how = 'copied'
+    shutil.copystat(src, dest)
+    st = os.stat(src)
+    os.chown(dest, st.st_uid, st.st_gid)
+    return how
+
+
+def _make_directory(target, st):
+    try:
+        os.mkdir(target)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(target):
+            raise
+    os.chown(target, st.st_uid, st.st_gid)
+    os.chmod(target, stat.S_IMODE(st.st_mode))
+
+
+def _make_special(target, st):
+    """Makes a FIFO or device node like the one st describes."""
+    if stat.S_ISFIFO(st.st_mode):
+        os.mkfifo(target, stat.S_IMODE(st.st_mode))
+    else:
+        os.mknod(target, st.st_mode, st.st_rdev)
+    os.chown(target, st.st_uid, st.st_gid)
+    os.chmod(target, stat.S_IMODE(st.st_mode))
+
+
+def copy_tree(src, dest, skip=(), skip_entry=None, threads=COPY_THREADS):
+    """
+    Copies the tree under src into dest, preserving symlinks, modes and
+    owners. Top-level names in skip aren't copied at all, nor is anything
+    for which skip_entry(name, lstat) is true.
+
+    Directories, symlinks, FIFOs and device nodes are made as the tree is
+    walked, and regular files are handed to a pool of threads to be linked
+    or copied by _clone_file. Sockets are skipped.
+    """
+    time_started = time.time()
+    files = Queue.Queue()
+    errors = []
+    counts = collections.Counter()
+    counts_lock = threading.Lock()
+
+    def copy_thread():
+        while True:
+            item = files.get()
+            if item is None:
+                return
+            file_src, file_dest, size = item
+            try:
+                how = _clone_file(file_src, file_dest)
+            except Exception:
+                errors.append(sys.exc_info())
+            else:
+                with counts_lock:
+                    counts[how] += 1
+                    counts['bytes'] += size
+
+    pool = [threading.Thread(target=copy_thread) for _ in xrange(threads)]
+    for t in pool:
+        t.start()
+
+    try:
+        skip = set(skip)
+        for root, dirs, names in os.walk(src):
+            rel = os.path.relpath(root, src)
+            if rel == '.':
+                dirs[:] = [d for d in dirs if d not in skip]
+                names = [n for n in names if n not in skip]
+                rel = ''
+            dest_root = os.path.join(dest, rel)
+
+            for name in dirs + names:
+                entry_src = os.path.join(root, name)
+                target = os.path.join(dest_root, name)
+                st = os.lstat(entry_src)
+                if skip_entry and skip_entry(name, st):
+                    if name in dirs:
+                        dirs.remove(name)
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(entry_src), target)
+                    os.lchown(target, st.st_uid, st.st_gid)
+                elif stat.S_ISDIR(st.st_mode):
+                    _make_directory(target, st)
+                elif stat.S_ISREG(st.st_mode):
+                    files.put((entry_src, target, st.st_size))
+                elif stat.S_ISSOCK(st.st_mode):
+                    print("skipping socket {}".format(entry_src))
+                else:
+                    _make_special(target, st)
+    finally:
+        for _ in pool:
+            files.put(None)
+        for t in pool:
+            t.join()
+
+    if errors:
+        # Re-raised with the copying thread's traceback
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+    taken = max(time.time() - time_started, 0.001)
+    n = counts['linked'] + counts['cloned'] + counts['copied']
+    mb = counts['bytes'] / 1e6
+    print("Copied {} files ({} linked, {} cloned, {} copied), {:.1f}MB "
+          "in {:.2f}s: {:.0f} files/s, {:.1f}MB/s".format(
+              n, counts['linked'], counts['cloned'], counts['copied'], mb,
+              taken, n / taken, mb / taken))
+
+
+class DiffReader(object):
+
+    def __init__(self, container):
+        self.container = container
+        self.client = container.client
+
+    @classmethod
+    def for_container(cls, container):
+        """Returns a reader for container, or None if it can't be used."""
+        raise NotImplementedError
+
+    def copy(self, dest):
+        raise NotImplementedError
+
+    def copy_path(self, src, dest):
+        """Copies what the container wrote under the directory src."""
+        raise NotImplementedError
+
+
+class LayerDiffReader(DiffReader):
+    """
+    Reads the container's layer straight from the directory the storage
+    driver keeps it in. Files are hard linked into the package directory
+    where it's on the same filesystem, which is safe as the container is
+    removed once it's been copied from.
+    """
+
+    driver_name = None
+
+    def __init__(self, container, directory):
+        super(LayerDiffReader, self).__init__(container)
+        self.directory = directory
+
+    def copy(self, dest):
+        print("Copying package data from container through {}...".
+              format(self.driver_name))
+        copy_tree(self.directory, dest,
+                  skip=self.container.docker_default_directories,
+                  skip_entry=self._is_whiteout)
+
+    def copy_path(self, src, dest):
+        src = os.path.join(self.directory, src.lstrip('/'))
+        if os.path.isdir(src):
+            copy_tree(src, dest, skip_entry=self._is_whiteout)
+
+    @staticmethod
+    def _is_whiteout(name, st):
+        raise NotImplementedError
+
+
+class AufsDiffReader(LayerDiffReader):
+
+    driver_name = "AUFS"
+
+    @classmethod
+    def for_container(cls, container):
+        root_dir = next((v for k, v in container.client.info()['DriverStatus']
+                         if k == "Root Dir"), None)
+        if root_dir:
+            directory = os.path.join(root_dir, 'diff', container.container_id)
+            if os.path.isdir(directory):
+                return cls(container, directory)
+
+    @staticmethod
+    def _is_whiteout(name, st):
+        return name.startswith(AUFS_WHITEOUT_PREFIX)
+
+
+class OverlayDiffReader(LayerDiffReader):
+    """
+    Reads the container's upper directory. Whiteouts (character devices
+    0/0) mark deleted files, which packages don't care about, so they're
+    skipped. Opaque directories hold all of their contents in the upper
+    directory, so need nothing special.
+    """
+
+    driver_name = "overlay"
+    DRIVERS = ('overlay', 'overlay2')
+
+    @classmethod
+    def for_container(cls, container):
+        graph_driver = container.client.inspect_container(
+            container.container_id).get('GraphDriver') or {}
+        if graph_driver.get('Name') in cls.DRIVERS:
+            directory = (graph_driver.get('Data') or {}).get('UpperDir')
+            if directory and os.path.isdir(directory):
+                return cls(container, directory)
+
+    @staticmethod
+    def _is_whiteout(name, st):
+        return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+class DockerApiDiffReader(DiffReader):
+
+    @classmethod
+    def for_container(cls, container):
+        return cls(container)
+
+    def copy(self, dest):
+        print("Copying package data from container through Docker...")
+
+        time_started = time.time()
+        diff = list(self.container.diff())
+        if len(diff) >= EXPORT_DIFF_THRESHOLD:
+            self._copy_from_export(diff, dest)
+        else:
+            paths = Queue.Queue()
+            for f in diff:
+                paths.put(f)
+            errors = []
+
+            # Threads take the next path as they finish the last one, so one
+            # large path doesn't hold up a whole slice behind it
+            def copy_thread():
+                while not errors:
+                    try:
+                        f = paths.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self._copy_file(f, dest)
+                    except Exception:
+                        errors.append(sys.exc_info())
+
+            threads = []
+            for _ in xrange(min(COPY_THREADS, len(diff))):
+                t = threading.Thread(target=copy_thread)
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+
+            if errors:
+                # Re-raised with the copying thread's traceback
+                exc_type, exc_value, exc_traceback = errors[0]
+                raise exc_type, exc_value, exc_traceback
+
+        print("Time taken: {}s".format(time.time() - time_started))
+
+    def _copy_from_export(self, diff, dest):
+        """
+        Streams one export of the whole container, extracting only what is
+        under the paths in its diff, rather than making a request per path.
+        The stream can't be read back, so hard links to files outside the
+        diff are fetched separately, as regular files.
+        """
+        wanted = set(p.lstrip('/') for p in diff)
+
+        def is_wanted(name):
+            name = os.path.normpath(name).lstrip('/')
+            while name and name != '.':
+                if name in wanted:
+                    return True
+                name = os.path.dirname(name)
+            return False
+
+        with closing(self.client.export(self.container.container_id)) \
+                as src_f, tarfile.open(fileobj=src_f, mode='r|') as tar:
+            outside_links = []
+            for member in tar:
+                if not is_wanted(member.name):
+                    continue
+                if member.islnk() and not is_wanted(member.linkname):
+                    outside_links.append(member)
+                else:
+                    tar.extract(member, dest)
+
+        for member in outside_links:
+            self._copy_link_target(member, dest)
+
+        for f in diff:
+            path = os.path.normpath(dest + f)
+            if os.path.exists(path):
+                os.chmod(path, 0o777)
+
+    def _copy_link_target(self, member, dest):
+        """Extracts the file hard link member points to in its place."""
+        with self.client.copy(self.container.container_id,
+                              '/' + member.linkname.lstrip('/')) as src_f, \
+                tarfile.open(fileobj=src_f, mode='r|') as tar:
+            for target in tar:
+                target.name = member.name
+                tar.extract(target, dest)
+                break
+
+    def copy_path(self, src, dest):
+        try:
+            response = self.client.copy(self.container.container_id, src)
+        except APIError:
+            print("nothing found in container at {}".format(src))
+            return
+        # The archive has the basename of src at the top, which is stripped
+        with response as src_f, tarfile.open(fileobj=src_f, mode='r|') as tar:
+            for member in tar:
+                name = member.name.split('/', 1)
+                if len(name) < 2 or not name[1]:
+                    continue
+                member.name = name[1]
+                if member.islnk():
+                    member.linkname = member.linkname.split('/', 1)[-1]
+                tar.extract(member, dest)
+
+    def _copy_file(self, src, dest):
+        if not os.path.isabs(src):
+            raise Exception("src must be an absolute path")
+
+        path = os.path.normpath(dest + src)
+        dest_dir = os.path.dirname(path)
+        try:
+            os.makedirs(dest_dir)
+        except OSError as e:
+            if not e.errno == errno.EEXIST:
+                raise
+
+        with self.client.copy(self.container.container_id, src) as src_f, \
+                tarfile.open(fileobj=src_f, mode='r|') as tar:
+            tar.extractall(dest_dir)
+
+        if os.path.exists(path):
+            os.chmod(path, 0o777)
+
+
+DIFF_READERS = [AufsDiffReader, OverlayDiffReader, DockerApiDiffReader]
+
+
+def get_diff_reader(container):
+    for cls in DIFF_READERS:
+        reader = cls.for_container(container)
+        if reader:
+            return reader
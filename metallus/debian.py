@@ -0,0 +1,296 @@
+# coding: utf-8
+
+"""
+Writes Debian binary packages without shelling out to fpm, and reads APT
+repository indexes.
+
+A .deb is an ar archive of debian-binary, control.tar.gz and data.tar.*, in
+that order. The control archive needs the md5sums of the data, so the data
+archive is streamed from the package directory into a temporary file first,
+hashing files as they are read, and then copied into place after the
+control archive. Package files are only read once.
+"""
+
+from __future__ import print_function
+
+import getpass
+import hashlib
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
+from cStringIO import StringIO
+
+DEBIAN_BINARY = "2.0\n"
+AR_MAGIC = "!<arch>\n"
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Compression name -> (file extension, command to pipe the tar through).
+# gzip is done in-process; Python 2 has no xz or zstd module.
+COMPRESSORS = {
+    'gz': ('gz', None),
+    'xz': ('xz', ['xz', '-c', '-6']),
+    'zstd': ('zst', ['zstd', '-c', '-q', '-19']),
+}
+MAINTAINER_SCRIPTS = ('preinst', 'postinst', 'prerm', 'postrm')
+
+_RELATION_PATTERN = re.compile(
+    r"\A\s*(?P<name>[^\s(<>=]+)\s*(?P<op><<|<=|>=|>>|=|<|>)\s*"
+    r"(?P<version>\S+)\s*\Z")
+
+
+def debian_relation(dep):
+    """Turns 'foo >= 1.0' or 'foo=1.0' into 'foo (>= 1.0)', as fpm does."""
+    m = _RELATION_PATTERN.match(dep)
+    if not m:
+        return dep.strip()
+    op = {'<': '<<', '>': '>>'}.get(m.group('op'), m.group('op'))
+    return "{} ({} {})".format(m.group('name'), op, m.group('version'))
+
+
+def _iter_lines(chunks):
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def gunzip_chunks(chunks):
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield d.decompress(chunk)
+    yield d.flush()
+
+
+def iter_packages_index(chunks):
+    """
+    Parses an APT Packages index given as an iterable of chunks of text,
+    yielding a dict of fields for each package as soon as it's been read.
+    Multi-line fields keep their continuation lines, joined by newlines.
+    """
+    fields = {}
+    last = None
+    for line in _iter_lines(chunks):
+        if not line.strip():
+            if fields:
+                yield fields
+            fields = {}
+            last = None
+        elif line[0] in " \t":
+            if last:
+                fields[last] += "\n" + line[1:]
+        else:
+            last, _, value = line.partition(":")
+            fields[last] = value.strip()
+    if fields:
+        yield fields
+
+
+def _fold_description(description):
+    """
+    Formats a description as a control field: the first line is the
+    synopsis, and each line after it is indented by a space, with blank ones
+    written as " .".
+    """
+    lines = description.strip().splitlines() or [""]
+    return "\n".join([lines[0].strip()] +
+                     [" " + line.rstrip() if line.strip() else " ."
+                      for line in lines[1:]])
+
+
+def _ar_header(name, size, mode=0o100644, mtime=None):
+    return "{:<16}{:<12}{:<6}{:<6}{:<8o}{:<10}`\n".format(
+        name, int(mtime or time.time()), 0, 0, mode, size)
+
+
+class _HashingReader(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+
+class DebianPackage(object):
+
+    def __init__(self, name, version, architecture, depends=None,
+                 conflicts=None, replaces=None, scripts=None, interests=None,
+                 activates=None, fields=None, description=None,
+                 maintainer=None, compression='gz'):
+        if compression not in COMPRESSORS:
+            raise ValueError("unknown compression '{}'; expected one of {}".
+                             format(compression, ", ".join(COMPRESSORS)))
+        self.name = name
+        self.version = version
+        self.architecture = architecture
+        self.depends = depends or []
+        self.conflicts = conflicts or []
+        self.replaces = replaces or []
+        self.scripts = scripts or {}
+        self.interests = interests or []
+        self.activates = activates or []
+        self.fields = fields or {}
+        self.description = description or "no description given"
+        self.maintainer = maintainer or "<{}@{}>".format(
+            getpass.getuser(), socket.gethostname())
+        self.compression = compression
+
+    def write(self, directory, path):
+        """Builds the package from the files under directory into path."""
+        ext, _ = COMPRESSORS[self.compression]
+        data_name = "data.tar.{}".format(ext)
+        with tempfile.TemporaryFile(dir=os.path.dirname(path)) as data_f:
+            md5sums, installed_size, conffiles = self._write_data(
+                directory, data_f)
+            data_f.seek(0, os.SEEK_END)
+            data_size = data_f.tell()
+            data_f.seek(0)
+            control = self._control_tar(md5sums, installed_size, conffiles)
+
+            with open(path, 'wb') as out:
+                out.write(AR_MAGIC)
+                self._write_ar_member(out, "debian-binary", DEBIAN_BINARY)
+                self._write_ar_member(out, "control.tar.gz", control)
+                out.write(_ar_header(data_name, data_size))
+                shutil.copyfileobj(data_f, out, COPY_BUFFER_SIZE)
+                if data_size % 2:
+                    out.write("\n")
+
+    def control(self, installed_size):
+        fields = [
+            ('Package', self.name),
+            ('Version', self.version),
+            ('Architecture', self.architecture),
+            ('Maintainer', self.maintainer),
+            ('Installed-Size', str(installed_size)),
+            ('Depends', ", ".join(map(debian_relation, self.depends))),
+            ('Conflicts', ", ".join(map(debian_relation, self.conflicts))),
+            ('Replaces', ", ".join(map(debian_relation, self.replaces))),
+            ('Section', 'default'),
+            ('Priority', 'extra'),
+        ] + sorted(self.fields.items()) + [
+            ('Description', _fold_description(self.description)),
+        ]
+        return "".join("{}: {}\n".format(k, v) for k, v in fields if v)
+
+    def _write_ar_member(self, out, name, data):
+        out.write(_ar_header(name, len(data)))
+        out.write(data)
+        if len(data) % 2:
+            out.write("\n")
+
+    def _open_tar(self, f):
+        _, command = COMPRESSORS[self.compression]
+        if command is None:
+            return tarfile.open(fileobj=f, mode='w|gz',
+                                format=tarfile.GNU_FORMAT), None
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+        return tarfile.open(fileobj=proc.stdin, mode='w|',
+                            format=tarfile.GNU_FORMAT), proc
+
+    def _write_data(self, directory, f):
+        md5sums = []
+        digests = {}
+        conffiles = []
+        installed_size = 0
+        tar, proc = self._open_tar(f)
+        try:
+            for root, dirs, files in os.walk(directory):
+                dirs.sort()
+                rel = os.path.relpath(root, directory)
+                arc_root = "." if rel == "." else "./" + rel
+                tar.addfile(self._tarinfo(tar, root, arc_root + "/"))
+                # Symlinks to directories come in dirs, but aren't walked
+                links = [d for d in dirs
+                         if os.path.islink(os.path.join(root, d))]
+                for name in sorted(files) + links:
+                    src = os.path.join(root, name)
+                    arcname = arc_root + "/" + name
+                    info = self._tarinfo(tar, src, arcname)
+                    if info is None:
+                        print("warning: skipping {}, which can't be "
+                              "packaged".format(src))
+                    elif info.isreg() or info.islnk():
+                        if info.isreg():
+                            with open(src, 'rb') as src_f:
+                                reader = _HashingReader(src_f)
+                                tar.addfile(info, reader)
+                            digests[arcname] = reader.md5.hexdigest()
+                            installed_size += info.size
+                        else:
+                            # A hard link to a file already in the package,
+                            # which dpkg still checks under its own name
+                            tar.addfile(info)
+                            digests[arcname] = digests[info.linkname]
+                        md5sums.append((digests[arcname], arcname[2:]))
+                        # Files in /etc are config files, as fpm has them
+                        if arcname.startswith("./etc/"):
+                            conffiles.append(arcname[1:])
+                    else:
+                        tar.addfile(info)
+        finally:
+            tar.close()
+            if proc:
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise Exception("{} failed compressing data for {}".
+                                    format(self.compression, self.name))
+        # Installed-Size is in kibibytes
+        return md5sums, (installed_size + 1023) // 1024, conffiles
+
+    def _tarinfo(self, tar, src, arcname):
+        """src's tar header, or None for sockets, which tar can't hold."""
+        info = tar.gettarinfo(src, arcname)
+        if info is None:
+            return None
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        return info
+
+    def _control_tar(self, md5sums, installed_size, conffiles=()):
+        files = [
+            ("control", self.control(installed_size), 0o644),
+            ("md5sums", "".join("{}  {}\n".format(*m) for m in md5sums),
+             0o644),
+        ]
+        if conffiles:
+            files.append(("conffiles", "".join(c + "\n" for c in conffiles),
+                          0o644))
+        triggers = ["interest {}\n".format(t) for t in self.interests] + \
+            ["activate {}\n".format(t) for t in self.activates]
+        if triggers:
+            files.append(("triggers", "".join(triggers), 0o644))
+        for name in MAINTAINER_SCRIPTS:
+            if name in self.scripts:
+                with open(self.scripts[name], 'rb') as f:
+                    files.append((name, f.read(), 0o755))
+
+        buf = StringIO()
+        with tarfile.open(fileobj=buf, mode='w:gz',
+                          format=tarfile.GNU_FORMAT) as tar:
+            now = int(time.time())
+            root = tarfile.TarInfo("./")
+            root.type = tarfile.DIRTYPE
+            root.mode = 0o755
+            root.mtime = now
+            tar.addfile(root)
+            for name, contents, mode in files:
+                info = tarfile.TarInfo("./" + name)
+                info.size = len(contents)
+                info.mode = mode
+                info.mtime = now
+                tar.addfile(info, StringIO(contents))
+        return buf.getvalue()
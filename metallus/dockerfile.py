@@ -11,10 +11,12 @@ from os import path
 import shutil
 
 from .utils import s3_deb_uri
+from .scheduler import _package_name as _bare_package_name
 from . import defaults
 
 DEP_MAKEFILE_PATH = "/tmp/metallus/build_deps/"  # trailing slash is needed
 MAKEFILE_NAME = "Makefile"
+APT_LAYER_BUCKETS = 4
 
 
 def get_dockerfile(project):
@@ -29,7 +31,10 @@ class DockerFile(object):
     
     def __init__(self, project):
         self.project = project
-        self.path_dir = path.join(defaults.HOME, project.path, 'image')
+        # Per job, so jobs being built at the same time by dist-all don't
+        # write over each other's Dockerfile
+        self.path_dir = path.join(defaults.HOME, project.path, 'image',
+                                  project.current_job.name)
 
         if not path.isdir(self.path_dir):
             os.makedirs(self.path_dir)
@@ -116,9 +121,38 @@ class AptDockerFile(DockerFile):
         self._add_apt_repos(self.repos)
 
         job = self.project.current_job
-        self._install_packages(job.build_depends)
+        if job.split_apt_layers:
+            self._flush_commands()
+            for layer in self._plan_layers(job.build_depends):
+                self._install_packages(layer)
+                self._flush_commands()
+        else:
+            self._install_packages(job.build_depends)
         self._flush_commands()
 
+    def _plan_layers(self, build_depends):
+        """
+        Splits build_depends into up to APT_LAYER_BUCKETS sorted sets, by a
+        hash of each package's name, so they can be installed in layers of
+        their own. Which layer a package lands in depends on nothing but its
+        name, without any version pin, so the Dockerfile stays the same for
+        the same build_depends, and a change to one package (or its pin)
+        only reinstalls its layer and the ones after it.
+        """
+        buckets = [[] for _ in range(APT_LAYER_BUCKETS)]
+        for d in build_depends or []:
+            name = _bare_package_name(d) or self._package_name(d)
+            digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+            buckets[int(digest, 16) % APT_LAYER_BUCKETS].append(d)
+        return [sorted(b, key=lambda d: (self._package_name(d),
+                                         json.dumps(d, sort_keys=True)))
+                for b in buckets if b]
+
+    def _package_name(self, software):
+        if type(software) is dict:
+            return software['name']
+        return software
+
     def _add_apt_keys(self, keys):
         for key in self.keys:
             self._add_command("curl '{0}' | apt-key add -".format(key))
@@ -242,11 +276,15 @@ class MakeDockerFile(DockerFile):
                         self.expand_make_file(prefix, mp)
 
     def hash(self):
-        SHAhash = hashlib.sha1()
-        
+        # Include the Dockerfile itself, as images are shared between jobs
+        # and its base image and target aren't in the copied files
+        SHAhash = hashlib.sha1(super(MakeDockerFile, self).hash())
+
         for root, dirs, files in os.walk(self.build_path):
-            for names in files:
+            dirs.sort()
+            for names in sorted(files):
                 filepath = os.path.join(root,names)
+                SHAhash.update(os.path.relpath(filepath, self.build_path))
                 with open(filepath, 'rb') as f:
                     while 1:
                         # Read file in as little chunks
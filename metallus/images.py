@@ -1,25 +1,155 @@
 # coding: utf-8
 
 from __future__ import print_function
+import collections
+import hashlib
+import json
+import os
+from os import path
 import subprocess
+import threading
+import time
 import docker
 
-from .utils import new_docker_client
+from .utils import new_docker_client, file_lock
 from docker.errors import APIError
 
+# Build dependency images are tagged with the hash of their Dockerfile
+# inputs only, so jobs and branches with the same inputs share them
+BUILD_DEPS_REPOSITORY = "metallus.build-deps"
+IMAGE_CACHE_DIR = "image-cache"
+DEFAULT_IMAGE_CACHE_BYTES = 20 * 1024 ** 3
+# Docker API read timeout for builds, which can be quiet for a long time
+BUILD_TIMEOUT = 60 * 60
+
+# The buildx builder used when there's a build_cache_dir. It's created with
+# the docker-container driver if it doesn't exist, as the default docker
+# driver can't export caches.
+DEFAULT_BUILDX_BUILDER = "metallus"
+_buildx_builder_lock = threading.Lock()
+
+# Tags this process's builds are still using, which eviction leaves alone
+_tags_in_use = collections.Counter()
+_tags_in_use_lock = threading.Lock()
+
 
 def get_repository_name(project, stage):
     return '.'.join([project.name, project.current_job.name, stage]).lower()
 
-def get_tag_with_hash(tag, hash):
-    return "{}-{}".format(tag, hash)
-            
+
+class ImageCache(object):
+    """
+    Content-addressed images in one repository, evicted least recently used
+    first once their total size goes over max_bytes. Last use times are kept
+    in a file under home, as Docker doesn't record them.
+    """
+
+    def __init__(self, repository, home, max_bytes=DEFAULT_IMAGE_CACHE_BYTES):
+        self.repository = repository
+        self.max_bytes = max_bytes
+        self.client = new_docker_client()
+        d = path.join(home, IMAGE_CACHE_DIR)
+        if not path.isdir(d):
+            os.makedirs(d)
+        self.index_path = path.join(d, repository + ".json")
+
+    def get(self, tag):
+        """
+        The image for tag, which isn't evicted by this process until it's
+        released. Docker won't remove it once there's a container using it.
+        """
+        with _tags_in_use_lock:
+            _tags_in_use[(self.repository, tag)] += 1
+        with file_lock(self.index_path + ".lock"):
+            last_used = self._read_index()
+            last_used[tag] = time.time()
+            self._write_index(last_used)
+        return Image(self.repository, tag)
+
+    def release(self, tag):
+        with _tags_in_use_lock:
+            _tags_in_use[(self.repository, tag)] -= 1
+            if _tags_in_use[(self.repository, tag)] <= 0:
+                del _tags_in_use[(self.repository, tag)]
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently used images until the layers they don't
+        share with the rest add up to no more than max_bytes, apart from
+        ones in keep or still in use.
+        """
+        with _tags_in_use_lock:
+            keep = set(keep) | set(t for r, t in _tags_in_use
+                                   if r == self.repository)
+        with file_lock(self.index_path + ".lock"):
+            last_used = self._read_index()
+            tag_layers = {}
+            layers_by_id = {}
+            for i in self.client.images(name=self.repository):
+                for repo_tag in i['RepoTags'] or []:
+                    repository, _, tag = repo_tag.rpartition(':')
+                    if repository == self.repository:
+                        if i['Id'] not in layers_by_id:
+                            layers_by_id[i['Id']] = self._layers(i['Id'])
+                        tag_layers[tag] = layers_by_id[i['Id']]
+            owners = collections.defaultdict(set)
+            sizes = {}
+            for tag, layers in tag_layers.iteritems():
+                for key, size in layers:
+                    owners[key].add(tag)
+                    sizes[key] = size
+            total = sum(sizes.itervalues())
+            for tag in sorted(tag_layers, key=lambda t: last_used.get(t, 0)):
+                if total <= self.max_bytes:
+                    break
+                if tag in keep:
+                    continue
+                repo_tag = "{}:{}".format(self.repository, tag)
+                print("evicting docker image {}".format(repo_tag))
+                try:
+                    self.client.remove_image(repo_tag)
+                except APIError:
+                    print("couldn't delete docker image {}".format(repo_tag))
+                else:
+                    for key, _ in tag_layers[tag]:
+                        owners[key].discard(tag)
+                        if not owners[key]:
+                            total -= sizes[key]
+                    last_used.pop(tag, None)
+            self._write_index(dict((t, v) for t, v in last_used.iteritems()
+                                   if t in tag_layers))
+
+    def _layers(self, image_id):
+        """
+        Keys and sizes of an image's layers. Layers are keyed by their
+        history from the base image up, as Docker doesn't give ids for ones
+        it pulled rather than built.
+        """
+        chain = hashlib.sha256()
+        layers = []
+        for h in reversed(self.client.history(image_id)):
+            chain.update(json.dumps([h.get('Id'), h.get('CreatedBy'),
+                                     h.get('Size', 0)]))
+            layers.append((chain.hexdigest(), h.get('Size', 0)))
+        return layers
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, last_used):
+        with open(self.index_path, 'w') as f:
+            json.dump(last_used, f)
+
+
 class Image(object):
     def __init__(self, repository, tag):
         self.repository = repository
         self.tag = tag 
         self.client = new_docker_client()
-        self.old_versions = []
         self._fetch_docker_image()
 
     @property
@@ -33,24 +163,58 @@ class Image(object):
         else:
             return self.repository
         
-    def create_image(self, dockerfile):
-        for i in self.old_versions: 
-            image_id = i['Id']
-            try:
-                self.client.remove_image(image_id)
-            except APIError as e:
-                print("couldn't delete docker image {}".format(image_id))
+    def create_image(self, dockerfile, cache_dir=None, builder=None):
+        """
+        Builds the image if it doesn't exist, printing the build's output
+        as it goes. Given a cache_dir, the build is done by BuildKit, with
+        the named buildx builder, which imports layers from and exports them
+        to a directory there for the job, so that other hosts sharing it
+        needn't start from scratch.
+        """
         try:
             if not self.docker_image:
                 print("creating image {0}".format(self.repo_tag))
-                subprocess.check_call(
-                    ['docker', 'build', '--rm', '-t', self.repo_tag, '.'],
-                    cwd=dockerfile.path_dir)
+                if cache_dir:
+                    self._buildx(dockerfile, cache_dir,
+                                 builder or DEFAULT_BUILDX_BUILDER)
+                else:
+                    self._build(dockerfile)
                 self._fetch_docker_image()
         except Exception as e:
             print("failed creating image {0}".format(self.repo_tag))
             raise e
 
+    def _build(self, dockerfile):
+        client = new_docker_client(timeout=BUILD_TIMEOUT)
+        for chunk in client.build(path=dockerfile.path_dir,
+                                  tag=self.repo_tag, rm=True, stream=True,
+                                  decode=True):
+            if 'error' in chunk:
+                raise ImageBuildError(chunk['error'])
+            if 'stream' in chunk:
+                print(chunk['stream'], end='')
+
+    def _buildx(self, dockerfile, cache_dir, builder):
+        _ensure_buildx_builder(builder)
+        job_cache = path.join(cache_dir, get_repository_name(
+            dockerfile.project, 'build-deps'))
+        args = ['docker', 'buildx', 'build', '--builder', builder,
+                '--progress=plain', '--load', '-t', self.repo_tag,
+                '--cache-to', 'type=local,mode=max,dest=' + job_cache]
+        if path.isfile(path.join(job_cache, 'index.json')):
+            args += ['--cache-from', 'type=local,src=' + job_cache]
+        env = dict(os.environ, DOCKER_BUILDKIT='1')
+        # Only one build writes to a job's cache at a time
+        with file_lock(job_cache + ".lock"):
+            proc = subprocess.Popen(args + ['.'], cwd=dockerfile.path_dir,
+                                    env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            for line in iter(proc.stdout.readline, ''):
+                print(line, end='')
+            if proc.wait() != 0:
+                raise ImageBuildError("docker buildx exited with {}".
+                                      format(proc.returncode))
+
     def exists(self):
         return bool(self.docker_image)
 
@@ -63,8 +227,24 @@ class Image(object):
         (i for i in images
          if self.repo_tag in i['RepoTags']),
         None)
-        if not self.docker_image:
-            self.old_versions = images
+
+
+def _ensure_buildx_builder(name):
+    """Creates the named buildx builder, unless it already exists."""
+    with _buildx_builder_lock, open(os.devnull, 'w') as devnull:
+        if subprocess.call(['docker', 'buildx', 'inspect', name],
+                           stdout=devnull, stderr=devnull) == 0:
+            return
+        print("creating buildx builder {}".format(name))
+        if subprocess.call(['docker', 'buildx', 'create', '--name', name,
+                            '--driver', 'docker-container']) != 0:
+            # Another process may have just created it
+            subprocess.check_call(['docker', 'buildx', 'inspect', name],
+                                  stdout=devnull)
+
+
+class ImageBuildError(Exception):
+    pass
 
 
 class ImageDoesNotExistError(Exception):
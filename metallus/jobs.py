@@ -13,6 +13,8 @@ class Job:
         self.images = values.get('images', [])
         self.base = values.get('base', None)
         self.persist = values.get('persist', [])
+        self.persist_mode = values.get('persist_mode', 'sync')
+        self.source_mode = values.get('source_mode', 'sync')
         self.environment = values.get('environment', {})
         self.build_depends = values.get('build_depends', [])
         self.build_depends_target = values.get('build_depends_target', None)
@@ -20,6 +22,10 @@ class Job:
         self.packages = values.get('packages', [])
         self.skip_tests = values.get('skip_tests', False)
         self.tests = values.get('tests', [])
+        self.depends_on = values.get('depends_on', [])
+        self.single_install_container = values.get(
+            'single_install_container', False)
+        self.split_apt_layers = values.get('split_apt_layers', False)
         if 'builder' not in values:
             raise JobPropertyNoneException(
                 "you must provide the 'builder' property "
@@ -0,0 +1,164 @@
+# coding: utf-8
+
+"""
+Read access to the buckets APT repositories are kept in.
+
+S3ObjectStore talks to S3, or anything that speaks its API such as MinIO,
+signing requests itself so there's no need for an AWS SDK. LocalObjectStore
+reads a directory laid out like a bucket, for local mirrors and for trying
+things out without S3.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from datetime import datetime
+import hashlib
+import hmac
+import os
+from os import path
+import urllib
+import urlparse
+
+import requests
+
+from .utils import s3_host
+
+CHUNK_SIZE = 64 * 1024
+EMPTY_PAYLOAD_HASH = hashlib.sha256("").hexdigest()
+
+
+class ObjectStoreError(Exception):
+    pass
+
+
+class ObjectStore(object):
+
+    def head(self, key):
+        """Returns the object's ETag, or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        Returns an iterator over the object's contents in chunks, or None if
+        it doesn't exist.
+        """
+        raise NotImplementedError
+
+
+class LocalObjectStore(ObjectStore):
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return path.join(self.root, *key.split('/'))
+
+    def head(self, key):
+        try:
+            st = os.stat(self._path(key))
+        except OSError:
+            return None
+        return '"{:x}-{:x}"'.format(int(st.st_mtime * 1e6), st.st_size)
+
+    def open(self, key):
+        fn = self._path(key)
+        if not path.isfile(fn):
+            return None
+
+        def chunks():
+            with open(fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    yield chunk
+        return chunks()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+class S3ObjectStore(ObjectStore):
+
+    def __init__(self, bucket, region=None, endpoint=None, access_id=None,
+                 secret_key=None, session_token=None):
+        self.bucket = bucket
+        self.region = region or "us-east-1"
+        self.endpoint = endpoint or "https://{}".format(s3_host(region))
+        self.access_id = access_id or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or \
+            os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.session_token = session_token or \
+            os.environ.get('AWS_SESSION_TOKEN')
+        self.session = requests.Session()
+
+    def _request(self, method, key, stream=False):
+        uri = urllib.quote("/{}/{}".format(self.bucket, key), safe='/~')
+        response = self.session.request(
+            method, self.endpoint.rstrip('/') + uri,
+            headers=self._signed_headers(method, uri), stream=stream,
+            timeout=60)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise ObjectStoreError("{} {} failed: {} {}".format(
+                method, uri, response.status_code, response.reason))
+        return response
+
+    def _signed_headers(self, method, uri):
+        """AWS signature version 4 headers, for a request without a body."""
+        if not (self.access_id and self.secret_key):
+            return {}
+        now = datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        headers = {
+            'host': urlparse.urlparse(self.endpoint).netloc,
+            'x-amz-content-sha256': EMPTY_PAYLOAD_HASH,
+            'x-amz-date': amz_date,
+        }
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+        signed_headers = ";".join(sorted(headers))
+        canonical_request = "\n".join([
+            method, uri, "",
+            "".join("{}:{}\n".format(k, headers[k]) for k in sorted(headers)),
+            signed_headers, EMPTY_PAYLOAD_HASH])
+        scope = "{}/{}/s3/aws4_request".format(date, self.region)
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope,
+            hashlib.sha256(canonical_request).hexdigest()])
+        signing_key = "AWS4" + self.secret_key
+        for part in (date, self.region, "s3", "aws4_request"):
+            signing_key = _hmac(signing_key, part)
+        headers['Authorization'] = (
+            "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, "
+            "Signature={}".format(
+                self.access_id, scope, signed_headers,
+                hmac.new(signing_key, string_to_sign,
+                         hashlib.sha256).hexdigest()))
+        return headers
+
+    def head(self, key):
+        response = self._request('HEAD', key)
+        if response is not None:
+            return response.headers.get('ETag')
+
+    def open(self, key):
+        response = self._request('GET', key, stream=True)
+        if response is not None:
+            return response.iter_content(CHUNK_SIZE)
+
+
+def get_object_store(repo, config):
+    """
+    The object store for an APT repository's bucket. Publishers can be
+    configured with an object_store URL: file:///some/dir reads buckets
+    from directories under it, and http(s) URLs are used as the S3 endpoint.
+    """
+    url = config.get('object_store')
+    if url and url.startswith('file://'):
+        return LocalObjectStore(path.join(url[len('file://'):],
+                                          repo['bucket']))
+    return S3ObjectStore(repo['bucket'], region=repo.get('region'),
+                         endpoint=url, access_id=repo.get('access_id'),
+                         secret_key=repo.get('secret_key'))
@@ -2,29 +2,50 @@
 
 from __future__ import print_function
 
+import collections
 from datetime import datetime
+import hashlib
+import json
 from os import path
 import os
-import shutil
+import Queue
 import subprocess
-import time
+import sys
+import tempfile
+import threading
 import traceback
 
 from .containers.container import Container, CONTAINER_HOME, CONTAINER_TEMP, \
-    CONTAINER_SOURCE
+    CONTAINER_SOURCE, CONTAINER_PACKAGES
 from . import publishers
+from .debian import DebianPackage, MAINTAINER_SCRIPTS
+from .utils import capture_output, print_block, sha256, fresh_directory
 
 PACKAGES_SCRIPTS_ROOT = "metallus/packages"
+DEFAULT_PACKAGE_WORKERS = 4
+MANIFEST_CACHE_DIR = "manifests"
+MANIFEST_CACHE_FORMAT = 3
+HASH_BUFFER_SIZE = 1024 * 1024
 
 
 class RepoManifest(object):
-
-    def __init__(self, publisher, repo, codename, component, arch):
+    """
+    Which version of each package was built from which commit, in one
+    repository's codename/component/arch. Indexes are kept on disk in
+    cache_dir along with the publisher's revision for them (e.g. an ETag),
+    and only listed again when the publisher reports a different one.
+    """
+
+    def __init__(self, publisher, repo, codename, component, arch,
+                 cache_dir=None):
         self.publisher = publisher
         self.repo = repo
         self.codename = codename
         self.component = component
         self.arch = arch
+        self.cache_path = cache_dir and os.path.join(cache_dir, sha256(
+            json.dumps([publisher.config_name, repo.get('bucket'), codename,
+                        component, arch])) + ".json")
         self._index_manifest()
 
     def _list_publisher(self):
@@ -32,16 +53,74 @@ class RepoManifest(object):
                                    component=self.component, arch=self.arch)
 
     def _index_manifest(self):
+        revision = self.publisher.manifest_revision(
+            repo=self.repo, codename=self.codename, component=self.component,
+            arch=self.arch)
+        if revision and self._load_cache(revision):
+            return
+
         self._package_git_commits_to_version = {}
         for fields in self._list_publisher():
             if 'Git-Commit-Id' in fields:
+                size = fields.get('Size')
                 self._package_git_commits_to_version[
                     (fields['Package'], fields['Git-Commit-Id'])] = \
-                    fields['Version']
+                    (fields['Version'], fields.get('Filename'),
+                     fields.get('SHA256'),
+                     int(size) if size and size.isdigit() else None)
+        if revision:
+            self._save_cache(revision)
+
+    def _load_cache(self, revision):
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if cached.get('revision') != revision or \
+                cached.get('format') != MANIFEST_CACHE_FORMAT:
+            return False
+        self._package_git_commits_to_version = dict(
+            ((package, commit), tuple(build))
+            for package, commit, build in cached['index'])
+        return True
+
+    def _save_cache(self, revision):
+        if not self.cache_path:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.cache_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'revision': revision, 'format': MANIFEST_CACHE_FORMAT,
+                       'index': [
+                           [package, commit, build]
+                           for (package, commit), build
+                           in self._package_git_commits_to_version.
+                           iteritems()]}, f)
+        os.rename(tmp, self.cache_path)
 
     def version_for_package_git_commit(self, package_name, git_commit_id):
         return self._package_git_commits_to_version.get(
-            (package_name, git_commit_id))
+            (package_name, git_commit_id), (None,) * 4)[0]
+
+    def file_for_package_git_commit(self, package_name, git_commit_id):
+        """
+        The build's path in the repository's pool, its SHA256 and its size,
+        each None if they weren't listed.
+        """
+        return self._package_git_commits_to_version.get(
+            (package_name, git_commit_id), (None,) * 4)[1:]
+
+
+def _file_sha256_and_size(path):
+    m = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), ''):
+            m.update(chunk)
+            size += len(chunk)
+    return m.hexdigest(), size
 
 
 class PackageManager(object):
@@ -57,9 +136,15 @@ class PackageManager(object):
                          if package_name is None or p['name'] == package_name]
         self.repos = repos
         self.repo_manifests = {}
+        self.manifest_cache_dir = os.path.join(
+            os.path.expanduser(config.home), MANIFEST_CACHE_DIR)
+        if not os.path.isdir(self.manifest_cache_dir):
+            os.makedirs(self.manifest_cache_dir)
         self.codename = codename
         self.component = 'main'  # TODO: maybe make this configurable?
         self.source_commit_id = project.source.hash
+        self.workers = max(1, config.defaults.get('package_workers',
+                                                  DEFAULT_PACKAGE_WORKERS))
 
     @property
     def should_package(self):
@@ -69,7 +154,44 @@ class PackageManager(object):
     def any_need_packaging(self):
         return any(p.needs_packaging for p in self.packages)
 
+    def prefetch_manifests(self):
+        """
+        Fetches every manifest promotion will look at, at the same time.
+        Publishers that can't be shared between threads get one thread each.
+        """
+        keys = {}
+        for packager in self.packages:
+            codenames = [self.codename] + \
+                (packager.codenames_promoting_from(self.codename) or [])
+            for repo_name in packager.repos:
+                for codename in codenames:
+                    mkey = (packager.publisher.package_type, repo_name,
+                            codename, self.component, packager.arch)
+                    if mkey not in self.repo_manifests:
+                        keys.setdefault(mkey, packager.publisher)
+
+        groups = collections.defaultdict(list)
+        for mkey, publisher in keys.iteritems():
+            if publisher.thread_safe:
+                groups[mkey].append((mkey, publisher))
+            else:
+                groups[id(publisher)].append((mkey, publisher))
+
+        def fetch(group):
+            for (_, repo_name, codename, component, arch), publisher \
+                    in group:
+                self._get_repo_manifest(publisher, repo_name, codename,
+                                        component, arch)
+
+        threads = [threading.Thread(target=fetch, args=(g,))
+                   for g in groups.itervalues()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
     def promote_possible_packages(self):
+        self.prefetch_manifests()
         # Return remaining ones
         out_packages = set(self.packages)
         for package in self.packages:
@@ -78,73 +200,274 @@ class PackageManager(object):
         return out_packages
 
     def package(self, image, packages=None):
-        for package in packages or self.packages:
-            self._run_packager(package, image)
+        """
+        Runs the packagers on a pool of threads, as they're independent of
+        each other. Each one's output is printed in one go once it's done.
+        """
+        packages = list(packages or self.packages)
+        install_container = None
+        if self.project.current_job.single_install_container:
+            installing = [p for p in packages if p.installs_in_container]
+            if installing:
+                install_container = self._create_install_container(
+                    image, installing)
+
+        queue = Queue.Queue()
+        for package in packages:
+            queue.put(package)
+        errors = []
+        built = []
+
+        def package_thread():
+            while True:
+                try:
+                    packager = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                with capture_output() as output:
+                    try:
+                        if packager.package(image, install_container):
+                            built.append(packager)
+                        else:
+                            print("skipping package build; no changes found")
+                    except Exception as e:
+                        traceback.print_exc(file=sys.stdout)
+                        errors.append(e)
+                print_block("==> {}\n{}".format(packager.name,
+                                                 output.getvalue()))
+
+        threads = [threading.Thread(target=package_thread)
+                   for _ in xrange(min(self.workers, queue.qsize()))]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if install_container:
+                install_container.remove()
+
         try:
             image.remove()
         except Exception as e:
             print(e)
 
+        try:
+            if built:
+                self.upload(built)
+        finally:
+            for packager in packages:
+                if os.path.isfile(packager.path):
+                    os.remove(packager.path)
+        if errors:
+            raise errors[0]
+
     def promote(self, packager):
-        if all(self._get_package_version(packager, r, self.codename,
-                                         self.component)
-               for r in packager.repos):
+        """
+        Publishes an existing build of this commit to the repos that don't
+        have it in this codename yet, instead of building it again. Repos
+        with it in a codename it's promoted through have it copied across,
+        and the others are given the .deb from another repo's pool. Returns
+        False, meaning it should be built, if no repo has it, if the
+        versions found don't agree, or if it can't be fetched.
+        """
+        codenames = [self.codename] + \
+            (packager.codenames_promoting_from(self.codename) or [])
+        found = {}
+        for repo_name in packager.repos:
+            for codename in codenames:
+                version = self._get_package_version(
+                    packager, repo_name, codename, self.component)
+                if version:
+                    found[(repo_name, codename)] = version
+
+        missing = [r for r in packager.repos
+                   if (r, self.codename) not in found]
+        if not missing:
             print("{} package already uploaded for commit {}".format(
                 packager.name, self.source_commit_id))
             return True
-
-        # TODO: maybe if the package exists in a proper subset of the repos,
-        # download it and upload it to the others? Currently we do a full
-        # rebuild if it doesn't exist in all of them.
-        from_codenames = packager.codenames_promoting_from(self.codename)
-        if not from_codenames:
-            print("No codename found to promote from")
-            return False
-
-        package_versions = [(cn, v) for cn, v in [
-            (cn, self._get_package_version(packager, rn, cn))
-            for cn in from_codenames
-            for rn in packager.repos
-        ] if v]
-        if package_versions:
-            from_codename, package_version = package_versions[0]
-        else:
+        if not found:
             print("Existing package not found in repository; building")
             return False
-        if not all(v == package_version for _, v in package_versions):
+        if len(set(found.values())) > 1:
             print("Inconsistent package versions found for commit; rebuilding")
             return False
+        version = found.values()[0]
+
+        copies, uploads = [], []
+        for repo_name in missing:
+            from_codenames = [cn for cn in codenames[1:]
+                              if (repo_name, cn) in found]
+            if from_codenames:
+                copies.append((repo_name, from_codenames[0]))
+            else:
+                uploads.append(repo_name)
 
-        print("No need to build, version {version} found. "
-              "Copying from {from_codename} to {to_codename}...".
-              format(version=package_version, from_codename=from_codename,
-                     to_codename=self.codename))
-
-        packager.publisher_copy(
-            to_codename=self.component, to_component=self.component,
-            versions=[package_version], from_codename=from_codename,
-            from_component=self.component)
+        if uploads and not self._fetch_existing_package(packager, found):
+            print("Existing package couldn't be fetched for {}; building".
+                  format(", ".join(uploads)))
+            return False
 
+        print("No need to build, version {} found. Publishing to {} in {}...".
+              format(version, ", ".join(missing), self.codename))
+        try:
+            self._fan_out(packager, version, copies, uploads)
+        finally:
+            if uploads and os.path.isfile(packager.path):
+                os.remove(packager.path)
         return True
 
-    def upload(self, package):
+    def _fetch_existing_package(self, packager, found):
+        """
+        Downloads the .deb for a build listed in found from the first repo
+        whose pool it can be fetched from, and points packager.path at it.
+        Fails if it doesn't match the SHA256 and size in the repo's index.
+        """
+        for repo_name, codename in sorted(found):
+            filename, expected_sha256, expected_size = self._get_repo_manifest(
+                packager.publisher, repo_name, codename, self.component,
+                packager.arch).file_for_package_git_commit(
+                    packager.name, self.source_commit_id)
+            if not filename:
+                continue
+            path = os.path.join(self.project.packages,
+                                os.path.basename(filename))
+            print("Fetching {} from {}".format(filename, repo_name))
+            if not packager.publisher.download(self.repos[repo_name],
+                                               filename, path):
+                continue
+            actual_sha256, actual_size = _file_sha256_and_size(path)
+            if (expected_sha256 and expected_sha256 != actual_sha256) or \
+                    (expected_size is not None and
+                     expected_size != actual_size):
+                print("{} from {} doesn't match its index: expected SHA256 "
+                      "{} and size {}, got {} and {}".format(
+                          filename, repo_name, expected_sha256, expected_size,
+                          actual_sha256, actual_size))
+                os.remove(path)
+                return False
+            packager.path = path
+            return True
+        return False
+
+    def _fan_out(self, packager, version, copies, uploads):
+        packager.version = version
+        errors = []
+
+        def publish(fn, *args):
+            with capture_output() as output:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stdout)
+                    errors.append(e)
+            print_block(output.getvalue())
+
+        def copy(repo_name, from_codename):
+            print("Copying {} {} from {} to {} in {}".format(
+                packager.name, version, from_codename, self.codename,
+                repo_name))
+            packager.publisher.copy(
+                repo=self.repos[repo_name], packager=packager,
+                to_codename=self.codename, to_component=self.component,
+                versions=[version], from_codename=from_codename,
+                from_component=self.component)
+
+        def upload(repo_name):
+            print("Uploading {} {} to {} in {}".format(
+                packager.name, version, self.codename, repo_name))
+            packager.publisher.upload_batch(
+                self.repos[repo_name], [packager], self.codename,
+                self.component)
+
+        tasks = [(copy, c) for c in copies] + \
+            [(upload, (r,)) for r in uploads]
+        if packager.publisher.thread_safe:
+            threads = [threading.Thread(target=publish, args=(fn,) + args)
+                       for fn, args in tasks]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        else:
+            for fn, args in tasks:
+                publish(fn, *args)
+        if errors:
+            raise errors[0]
+
+    def upload(self, packagers):
+        """
+        Publishes the packages a repository at a time, so that publishers
+        which can batch them update each repository's indexes once.
+        Different repositories are published to in parallel.
+        """
         if not self.codename:
             raise TypeError("Expected codename to be present; not {!r}".
                             format(self.codename))
-        package.publisher_upload(self.codename, self.component)
-        print('uploaded package')
-        print(' name : {}'.format(package.name))
-        print(' version : {}'.format(package.version))
-
-    def _run_packager(self, packager, image):
-        try:
-            if packager.package(image):
-                self.upload(packager)
-            else:
-                print("skipping package build; no changes found")
-        finally:
-            if os.path.isfile(packager.path):
-                os.remove(packager.path)
+        batches = collections.OrderedDict()
+        for packager in packagers:
+            for repo_name in packager.repos:
+                batches.setdefault((packager.publisher.config_name,
+                                    repo_name), []).append(packager)
+
+        groups = collections.defaultdict(list)
+        for key, batch in batches.iteritems():
+            publisher = batch[0].publisher
+            groups[key if publisher.thread_safe else id(publisher)]. \
+                append((key[1], batch))
+        errors = []
+
+        def upload_thread(group):
+            for repo_name, batch in group:
+                with capture_output() as output:
+                    try:
+                        batch[0].publisher.upload_batch(
+                            self.repos[repo_name], batch, self.codename,
+                            self.component)
+                        for packager in batch:
+                            print('uploaded package')
+                            print(' name : {}'.format(packager.name))
+                            print(' version : {}'.format(packager.version))
+                    except Exception as e:
+                        traceback.print_exc(file=sys.stdout)
+                        errors.append(e)
+                print_block("==> {}\n{}".format(repo_name,
+                                                 output.getvalue()))
+
+        threads = [threading.Thread(target=upload_thread, args=(g,))
+                   for g in groups.itervalues()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _create_install_container(self, image, packagers):
+        """
+        Installs every packager's target in one container, each into its
+        own DESTDIR under CONTAINER_PACKAGES, for the packagers to copy from.
+        """
+        print("installing {} in one container".format(
+            ", ".join(p.name for p in packagers)))
+        c = Container(image,
+                      ['/bin/bash /scripts/with-source '
+                       '/bin/bash /scripts/make-install-all'],
+                      env={'HOME': CONTAINER_HOME,
+                           'TARGETS': "\n".join(
+                               "{} {}".format(p.name, p.config['target'])
+                               for p in packagers),
+                           'PACKAGES_ROOT': CONTAINER_PACKAGES,
+                           'SOURCE_ROOT': CONTAINER_SOURCE,
+                           'TEMP_ROOT': CONTAINER_TEMP,
+                           'START_IN': self.project.current_job.start_in},
+                      volumes=self.project.docker_volumes)
+        c.start()
+        if c.status > 0:
+            c.remove()
+            raise PackageException(c.status)
+        return c
 
     def _get_repo_manifest(self, publisher, repo_name, codename, component,
                            arch):
@@ -157,7 +480,8 @@ class PackageManager(object):
             print("Getting manifest for {repo_name} {codename}...".
                   format(**locals()))
             m = RepoManifest(publisher, self.repos[repo_name], codename,
-                             component, arch)
+                             component, arch,
+                             cache_dir=self.manifest_cache_dir)
             self.repo_manifests[mkey] = m
             return m
 
@@ -247,24 +571,32 @@ class Packager(object):
                 del promote_through[i]
                 return promote_through
 
-    def package(self, image):
+    @property
+    def installs_in_container(self):
+        return bool(self.needs_packaging and
+                    self.config.get('copy_diff', True) and
+                    self.config['target'])
+
+    def package(self, image, install_container=None):
         if not self.needs_packaging:
             return False
 
         self.clean()
-        if self.config.get('copy_diff', True):
+        if install_container and self.installs_in_container:
+            install_container.copy_path(
+                os.path.join(CONTAINER_PACKAGES, self.name), self.directory)
+        elif self.config.get('copy_diff', True):
             self.copy(image)
-        self.debian_scripts()
-        self.fpm()
+        if self.config.get('deb_builder') == 'fpm':
+            self.fpm()
+        else:
+            self.build_deb()
         return True
 
     def clean(self):
+        """Gives the package a fresh, empty directory."""
         print("cleaning package directory {}".format(self.directory))
-        if os.path.isdir(self.directory):
-            shutil.rmtree(self.directory)
-        time.sleep(2)
-        if not os.path.isdir(self.directory):
-            os.makedirs(self.directory)
+        fresh_directory(self.directory)
 
     def copy(self, image):
         container = self._create_container(image)
@@ -280,20 +612,6 @@ class Packager(object):
         finally:
             container.remove()
 
-    def publisher_copy(self, to_codename, to_component, from_codename,
-                       from_component, versions):
-        if isinstance(versions, basestring):
-            versions = versions.split(' ')
-        for r in self.repo_dicts:
-            self.publisher.copy(
-                repo=r, packager=self, to_codename=to_codename,
-                to_component=to_component, from_codename=from_codename,
-                from_component=from_component, versions=versions)
-
-    def publisher_upload(self, codename, component):
-        for r in self.repo_dicts:
-            self.publisher.upload(r, self, codename, component)
-
     def fpm(self):
         paths = []
         for name in os.listdir(self.directory):
@@ -318,18 +636,41 @@ class Packager(object):
              '-v', str(self.version)] + paths
         subprocess.call(args)
 
+    def build_deb(self):
+        print("building {}".format(self.path))
+        DebianPackage(
+            name=self.config['name'], version=str(self.version),
+            architecture=self.arch,
+            depends=self.config.get('depends', []),
+            conflicts=self.config.get('conflicts', []),
+            replaces=self.config.get('replaces', []),
+            scripts=self.maintainer_scripts(),
+            interests=self.config.get('interests', []),
+            activates=self.config.get('activates', []),
+            fields={'Git-Commit-Id': self.project.source.hash},
+            description=self.config.get('description'),
+            maintainer=self.config.get('maintainer'),
+            compression=self.config.get('compression', 'gz'),
+        ).write(self.directory, self.path)
+
+    def maintainer_scripts(self):
+        scripts = {}
+        for k in MAINTAINER_SCRIPTS:
+            path = os.path.join(self.project.source.path,
+                                PACKAGES_SCRIPTS_ROOT, self.name, k)
+            if os.path.isfile(path):
+                scripts[k] = path
+        return scripts
+
     def debian_scripts(self):
         args = []
         scripts = {'postinst': '--post-install',
                    'prerm': '--pre-uninstall',
                    'preinst': '--pre-install',
                    'postrm': '--post-uninstall'}
-        for k, v in scripts.iteritems():
-            path = os.path.join(self.project.source.path,
-                                PACKAGES_SCRIPTS_ROOT, self.name, k)
-            if os.path.isfile(path):
-                args.append(v)
-                args.append(path)
+        for k, script in self.maintainer_scripts().iteritems():
+            args.append(scripts[k])
+            args.append(script)
         return args
 
     def interests(self):
@@ -367,7 +708,8 @@ class Packager(object):
 
     def _create_container(self, image):
         c = Container(image,
-                      ['/bin/bash /scripts/make-install'],
+                      ['/bin/bash /scripts/with-source '
+                       '/bin/bash /scripts/make-install'],
                       env={'HOME': CONTAINER_HOME,
                            'TARGET': self.config['target'],
                            'SOURCE_ROOT': CONTAINER_SOURCE,
@@ -0,0 +1,231 @@
+# coding: utf-8
+
+"""
+The directories jobs' persisted folders are kept in between builds, under
+the project's shared directory as <branch>/<job>/<sha256(folder)>.
+
+A branch's first build starts from a clone of the seed branch's directory,
+rather than from nothing. Sizes and last use times are kept in an index
+alongside them, and once they're over budget the least recently used are
+deleted. A clone starts with the seed's size, and sizes are measured again
+in the background after each use, so builds don't wait on walking them.
+Directories are locked while a build is using them, so they're neither
+cloned half-written nor deleted from under it.
+"""
+
+from __future__ import print_function
+
+from contextlib import contextmanager
+import json
+import os
+from os import path
+import re
+import subprocess
+import threading
+import time
+import uuid
+
+from .utils import file_lock, LockTimeoutError, reap_in_background, \
+    sha256, REAP_DIRECTORY_FORMAT
+
+DEFAULT_SEED_BRANCH = "master"
+INDEX_FILENAME = "persist-cache.json"
+ENTRY_PATTERN = re.compile(r"\A[0-9a-f]{64}\Z")
+REAP_PATTERN = re.compile(r"\A\..*\.reap-[0-9a-f]+\Z")
+SEED_DIRECTORY_FORMAT = ".{name}.seed-{id}"
+# Kept beside each entry, and mounted beside it in the build container, to
+# mark when its permissions were last normalised (see scripts/persist)
+NORMALISED_STAMP_SUFFIX = ".normalised"
+
+
+def _disk_usage(root):
+    """
+    Bytes used on disk under root, counting hard linked files once, or None
+    if it can't be measured, e.g. as it's been evicted.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(
+                ['du', '-s', '-B1', '--one-file-system', root],
+                stderr=devnull)
+        return int(out.split()[0])
+    except (subprocess.CalledProcessError, OSError, ValueError, IndexError):
+        return None
+
+
+class PersistCache(object):
+
+    def __init__(self, shared, max_bytes=None,
+                 seed_branch=DEFAULT_SEED_BRANCH):
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.seed_branch = seed_branch
+        self.index_path = path.join(shared, INDEX_FILENAME)
+
+    def entry(self, branch, job_name, folder):
+        """
+        The directory for a persisted folder, seeded from the seed branch's
+        if it doesn't exist yet. Seeds are copied, as reflinks where the
+        filesystem supports them, never hard linked, as builds and rsync
+        change files in place.
+        """
+        key = path.join(branch, job_name, sha256(folder))
+        p = path.join(self.shared, key)
+        if path.isdir(p):
+            if not path.isfile(p + NORMALISED_STAMP_SUFFIX):
+                with open(p + NORMALISED_STAMP_SUFFIX, 'w'):
+                    pass
+            return key, p
+
+        seed_key = path.join(self.seed_branch, job_name, sha256(folder))
+        seed = path.join(self.shared, seed_key)
+        seeded = False
+        parent = path.dirname(p)
+        if not path.isdir(parent):
+            os.makedirs(parent)
+        if branch != self.seed_branch and path.isdir(seed):
+            tmp = path.join(parent, SEED_DIRECTORY_FORMAT.format(
+                name=path.basename(p), id=uuid.uuid4().hex))
+            try:
+                with file_lock(seed + ".lock", timeout=0):
+                    print("seeding {} from {}".format(folder,
+                                                      self.seed_branch))
+                    subprocess.check_call(['cp', '-a', '--reflink=auto',
+                                           seed, tmp])
+                os.rename(tmp, p)
+                seeded = True
+            except (LockTimeoutError, subprocess.CalledProcessError,
+                    OSError) as e:
+                print("couldn't seed {} from {}: {}".format(
+                    folder, self.seed_branch, e))
+                if path.isdir(tmp):
+                    reap = self._reap_path(p)
+                    os.rename(tmp, reap)
+                    reap_in_background([reap])
+        if not path.isdir(p):
+            os.makedirs(p)
+        # Anything left from an evicted entry would make the new one look
+        # normalised already
+        with open(p + NORMALISED_STAMP_SUFFIX, 'w'):
+            pass
+        self._add(key, seed_key if seeded else None)
+        return key, p
+
+    def _add(self, key, seed_key=None):
+        """Indexes a new entry, with its seed's size if it has one."""
+        with file_lock(self.index_path + ".lock"):
+            index = self._read_index()
+            size = index.get(seed_key, {}).get('size', 0) if seed_key else 0
+            index[key] = {'last_used': time.time(), 'size': size}
+            self._write_index(index)
+
+    @contextmanager
+    def using(self, entries):
+        """
+        Locks the given (key, path) entries while they're used, then records
+        their use, evicts others if over budget, and measures their sizes in
+        the background.
+        """
+        try:
+            locks = []
+            try:
+                for _, p in entries:
+                    lock = file_lock(p + ".lock")
+                    lock.__enter__()
+                    locks.append(lock)
+                yield
+            finally:
+                for lock in reversed(locks):
+                    lock.__exit__(None, None, None)
+        finally:
+            self._record([key for key, _ in entries])
+            # Not a daemon, so the sizes are kept even if the process is
+            # about to exit
+            t = threading.Thread(target=self._measure, args=(entries,))
+            t.start()
+
+    def _reap_path(self, p):
+        return path.join(path.dirname(p), REAP_DIRECTORY_FORMAT.format(
+            name=path.basename(p), id=uuid.uuid4().hex))
+
+    def _measure(self, entries):
+        sizes = dict((key, _disk_usage(p)) for key, p in entries)
+        with file_lock(self.index_path + ".lock"):
+            index = self._read_index()
+            for key, size in sizes.iteritems():
+                if key in index and size is not None:
+                    index[key]['size'] = size
+            self._write_index(index)
+
+    def _record(self, keys):
+        with file_lock(self.index_path + ".lock"):
+            index = self._read_index()
+            now = time.time()
+            for key in keys:
+                index[key] = {'last_used': now,
+                              'size': index.get(key, {}).get('size', 0)}
+            reap = self._scan(index)
+            if self.max_bytes is not None:
+                reap += self._evict(index, keep=set(keys))
+            self._write_index(index)
+        reap_in_background(reap)
+
+    def _scan(self, index):
+        """
+        Brings the index up to date with what's on disk, including
+        directories from before it was kept, and returns any evicted ones
+        left behind by runs that exited before deleting them.
+        """
+        for key in list(index):
+            if not path.isdir(path.join(self.shared, key)):
+                del index[key]
+        reap = []
+        for dirpath, dirs, files in os.walk(self.shared):
+            for name in list(dirs):
+                p = path.join(dirpath, name)
+                if REAP_PATTERN.match(name):
+                    reap.append(p)
+                elif name.startswith('.'):
+                    pass
+                elif ENTRY_PATTERN.match(name):
+                    key = path.relpath(p, self.shared)
+                    if key not in index:
+                        index[key] = {'last_used': path.getmtime(p),
+                                      'size': _disk_usage(p) or 0}
+                else:
+                    continue
+                dirs.remove(name)
+        return reap
+
+    def _evict(self, index, keep):
+        total = sum(e['size'] for e in index.itervalues())
+        reap = []
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            p = path.join(self.shared, key)
+            try:
+                with file_lock(p + ".lock", timeout=0):
+                    print("evicting persisted folder {}".format(key))
+                    if path.isdir(p):
+                        reap.append(self._reap_path(p))
+                        os.rename(p, reap[-1])
+                    if path.isfile(p + NORMALISED_STAMP_SUFFIX):
+                        os.remove(p + NORMALISED_STAMP_SUFFIX)
+            except LockTimeoutError:
+                continue
+            total -= index.pop(key)['size']
+        return reap
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        with open(self.index_path, 'w') as f:
+            json.dump(index, f)
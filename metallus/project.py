@@ -10,7 +10,7 @@ import urlparse
 from .source import Git
 from .utils import sha256
 from .jobs import Job
-from .containers.container import CONTAINER_TEMP
+from .containers.container import CONTAINER_TEMP, CONTAINER_OVERLAY
 
 
 GIT_URL_PATTERN = re.compile(
@@ -19,6 +19,9 @@ GITHUB_PATTERN = re.compile(
     r"\Agit@github.com:(?P<user>[^/]+)/(?P<repo>[^/]+?)(?:\.git)?\Z")
 SCRIPTS_DIR = os.path.abspath(pkg_resources.resource_filename(
     __name__, 'scripts'))
+# Checkout used only to read metallus.yml when no job has been picked yet,
+# e.g. to list the jobs for `metallus dist-all`.
+JOB_INDEX_CHECKOUT = ".index"
 
 
 def _format_docker_volume(src, dest):
@@ -31,11 +34,12 @@ class JobNotFoundError(Exception):
 
 class Project(object):
 
-    def __init__(self, scm_path, home, branch, job_name):
+    def __init__(self, scm_path, home, branch, job_name=None):
         self.name, scm_path, scm_cls = self._parse_scm_path(scm_path)
         self.branch = branch
         self.path = path.join(home, 'projects', self.name)
-        self.source = scm_cls(scm_path, self.path, branch, job_name)
+        self.source = scm_cls(scm_path, self.path, branch,
+                              job_name or JOB_INDEX_CHECKOUT)
         self.shared = path.join(self.path, 'shared')
         self.packages = path.join(self.path, 'packages')
         self.image_id = sha256(self.source.path)
@@ -50,22 +54,34 @@ class Project(object):
         self.jobs = []
         for job in self.source.settings['jobs']:
             self.jobs.append(Job(job, self.source.settings['jobs'][job]))
-        jobs = [j for j in self.jobs if j.name == job_name]
-        try:
-            self.current_job = jobs[0]
-        except IndexError:
-            raise JobNotFoundError(job_name)
+        if job_name is None:
+            self.current_job = None
+        else:
+            jobs = [j for j in self.jobs if j.name == job_name]
+            try:
+                self.current_job = jobs[0]
+            except IndexError:
+                raise JobNotFoundError(job_name)
 
         self.skip_all = self.source.skip_all
-        self.skip_tests = self.source.skip_tests or self.current_job.skip_tests
+        self.skip_tests = self.source.skip_tests or \
+            bool(self.current_job and self.current_job.skip_tests)
         self.num_commits = self.source.num_commits
 
         self.branch_codenames = (self.source.settings.
                                  get('packages', {}).
                                  get('branch_codenames', {}))
+        volumes = [(SCRIPTS_DIR, '/scripts'),
+                   (self.source.path, CONTAINER_TEMP)]
+        if self.current_job and self.current_job.source_mode == 'overlay':
+            self.source_overlay = path.join(self.path, 'overlay',
+                                            self.source.current_branch,
+                                            self.current_job.name)
+            volumes.append((self.source_overlay, CONTAINER_OVERLAY))
+        else:
+            self.source_overlay = None
         self.docker_volumes = map(lambda a: _format_docker_volume(*a),
-                                  [(SCRIPTS_DIR, '/scripts'),
-                                   (self.source.path, CONTAINER_TEMP)])
+                                  volumes)
 
     def _parse_scm_path(self, scm_path):
         m = GIT_URL_PATTERN.match(scm_path)
@@ -72,6 +72,9 @@ class PublisherMeta(type):
 class Publisher(object):
     __metaclass__ = PublisherMeta
 
+    # Whether one instance can be used from several threads at once
+    thread_safe = True
+
     def __init__(self, **config):
         self.config = config
         self._after_init()
@@ -79,6 +82,30 @@ class Publisher(object):
     def _after_init(self):
         pass
 
+    def manifest_revision(self, repo, codename, component, arch):
+        """
+        Returns something that changes whenever list() would return
+        something different, such as an ETag, or None if that can't be told
+        without listing.
+        """
+        return None
+
+    def download(self, repo, filename, path):
+        """
+        Fetches a file from the repository, such as a package from its pool,
+        to path. Returns False if it can't be fetched.
+        """
+        return False
+
+    def upload_batch(self, repo, packagers, codename, component):
+        """
+        Uploads several packages to one repository. Publishers that can
+        update the repository's indexes once for all of them should
+        override this.
+        """
+        for packager in packagers:
+            self.upload(repo, packager, codename, component)
+
 
 # Allow all other modules in this package to register with the above
 import pkgutil
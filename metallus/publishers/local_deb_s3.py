@@ -6,15 +6,20 @@ from __future__ import absolute_import
 from contextlib import contextmanager
 import os
 from os import path
-import fcntl
-import re
 import subprocess
+import time
 
 from . import Publisher, DEFAULT_CACHE_CONTROL
 from .. import config
-from ..utils import s3_host
+from ..debian import iter_packages_index, gunzip_chunks
+from ..object_store import get_object_store
+from ..utils import s3_host, file_lock, sha256
 
-DEB_S3_LOCK = "deb-s3.lock"
+DEB_S3_LOCK_FORMAT = "deb-s3.{}.lock"
+
+
+def packages_index_key(codename, component, arch):
+    return "dists/{}/{}/binary-{}/Packages".format(codename, component, arch)
 
 
 def deb_s3_args(subcommand, *args, **kwargs):
@@ -38,38 +43,70 @@ def deb_s3_args(subcommand, *args, **kwargs):
 
 
 @contextmanager
-def deb_s3_lock():
-    fn = path.join(os.path.expanduser(config.current().home), DEB_S3_LOCK)
-    with open(fn, 'w') as lock:
-        print("Trying to acquire deb-s3 lock...")
-        fcntl.lockf(lock, fcntl.LOCK_EX)
+def deb_s3_lock(repo, codename, timeout=None):
+    """
+    Locks one codename's indexes, so that publishing to unrelated buckets or
+    codenames can go ahead at the same time. Components can't be locked
+    separately: deb-s3 rewrites dists/<codename>/Release, which lists every
+    component's indexes, from the copy it read before uploading, so
+    concurrent uploads to different components would lose each other's
+    entries.
+    """
+    name = "{}/{}".format(repo['bucket'], codename)
+    fn = path.join(os.path.expanduser(config.current().home),
+                   DEB_S3_LOCK_FORMAT.format(sha256(name)[:16]))
+    print("Trying to acquire deb-s3 lock for {}...".format(name))
+    started = time.time()
+    with file_lock(fn, timeout=timeout):
         try:
-            print("Lock aquired.")
+            print("Lock aquired after {:.2f}s.".format(time.time() - started))
             yield
         finally:
-            print("Releasing deb-s3 lock")
-            fcntl.lockf(lock, fcntl.LOCK_UN)
+            print("Releasing deb-s3 lock for {}".format(name))
 
 
 class LocalDebS3Publisher(Publisher):
     package_type = "debian"
     config_name = "local-deb-s3"
 
-    MANIFEST_LINE_PATTERN = re.compile(r"^(\S+?): (\S.*)$",
-                                       re.MULTILINE | re.UNICODE)
+    def manifest_revision(self, repo, codename, component, arch):
+        store = get_object_store(repo, self.config)
+        key = packages_index_key(codename, component, arch)
+        return store.head(key + ".gz") or store.head(key)
 
     def list(self, repo, codename, component, arch):
-        # No need for deb-s3 lock, as it's read-only
-        raw = subprocess.check_output(deb_s3_args('list', repo=repo, long=True,
-                        codename=codename, component=component, arch=arch))
-        print("deb-s3 command result: '{}'".format(raw))
-        return [dict(LocalDebS3Publisher.MANIFEST_LINE_PATTERN.findall(p))
-                for p in raw.split("\n\n")]
+        # No need for deb-s3 lock, as it's read-only. Reads the Packages
+        # index straight from the bucket, rather than through deb-s3.
+        store = get_object_store(repo, self.config)
+        key = packages_index_key(codename, component, arch)
+        chunks = store.open(key + ".gz")
+        if chunks is not None:
+            chunks = gunzip_chunks(chunks)
+        else:
+            chunks = store.open(key)
+        if chunks is None:
+            print("No Packages index found at {}".format(key))
+            return iter([])
+        return iter_packages_index(chunks)
+
+    def download(self, repo, filename, path):
+        chunks = get_object_store(repo, self.config).open(filename)
+        if chunks is None:
+            return False
+        try:
+            with open(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception:
+            os.remove(path)
+            raise
+        return True
 
     def copy(self, repo, packager, from_codename, from_component,
              to_codename, to_component, versions):
         versions = ' '.join(versions)
-        with deb_s3_lock():
+        with deb_s3_lock(repo, to_codename,
+                         timeout=self.config.get('lock_timeout')):
             return subprocess.check_call(deb_s3_args(
                 'copy', packager.name, to_codename, to_component, repo=repo,
                 preserve_versions=True, versions=versions,
@@ -77,8 +114,15 @@ class LocalDebS3Publisher(Publisher):
                 component=from_component, cache_control=DEFAULT_CACHE_CONTROL))
 
     def upload(self, repo, packager, codename, component):
-        with deb_s3_lock():
+        return self.upload_batch(repo, [packager], codename, component)
+
+    def upload_batch(self, repo, packagers, codename, component):
+        # deb-s3 uploads every package it's given and then rewrites and
+        # signs the indexes they're in once, rather than once per package
+        paths = [p.path for p in packagers]
+        with deb_s3_lock(repo, codename,
+                         timeout=self.config.get('lock_timeout')):
             return subprocess.check_call(
-                deb_s3_args('upload', packager.path, preserve_versions=True,
+                deb_s3_args('upload', *paths, preserve_versions=True,
                             repo=repo, codename=codename, component=component,
                             cache_control=DEFAULT_CACHE_CONTROL))
@@ -1,19 +1,118 @@
 # coding: utf-8
 
+"""
+Publishes through a Tansit server, over ZeroMQ.
+
+By default packages are sent as base64 in send_package_data JSON-RPC
+notifications, on the same connection as the upload call that follows.
+When the publisher is configured with a data_endpoint, they're streamed to
+it as raw binary frames instead, from a DEALER socket:
+
+    client -> server: [b"package_data", header, data]
+        header is JSON: {"file_name": ..., "chunk": n, "new_file": n == 0}
+        data is bytes n * BINARY_CHUNK_SIZE up to the next chunk
+    server -> client: [b"package_data_ack", header]
+        header is JSON: {"file_name": ..., "chunk": n}
+
+Chunks are sent in order, and up to upload_window of them may be
+unacknowledged at once. Acks are cumulative: an ack for chunk n means the
+server has every chunk up to and including n, so it needn't ack each one.
+An ack for a chunk that hasn't been sent, or one behind an earlier ack, is
+a protocol error. If no ack arrives for ack_timeout milliseconds, the
+client asks how many chunks the server has, with the
+package_data_received(file_name) JSON-RPC call, and resends from there on
+a new socket. The upload call is then made over JSON-RPC as usual, with
+the SHA256 of the whole file.
+"""
+
 from __future__ import print_function
 from __future__ import absolute_import
 
+from contextlib import contextmanager
 import os.path
 import hashlib
+import json
 import sys
+import threading
+import time
 from base64 import urlsafe_b64encode
 
 from jsonrpc2_zeromq import RPCNotifierClient
+import zmq
 
 from . import Publisher, DEFAULT_CACHE_CONTROL
 
 PACKAGE_SEND_CHUNK_SIZE = 250000
 
+# Binary uploads, over the data_endpoint socket
+PACKAGE_DATA_FRAME = b"package_data"
+PACKAGE_DATA_ACK_FRAME = b"package_data_ack"
+BINARY_CHUNK_SIZE = 1024 * 1024
+DEFAULT_UPLOAD_WINDOW = 16
+DEFAULT_ACK_TIMEOUT = 30 * 1000
+DEFAULT_UPLOAD_RETRIES = 3
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+
+DEFAULT_CONNECTIONS = 8
+# FIXME: Set timeout per-request when that lands in jsonrpc2_zeromq
+RPC_TIMEOUT = 120 * 1000
+
+
+class _AckTimeout(Exception):
+    pass
+
+
+class _RPCClient(RPCNotifierClient):
+
+    def _reconnect_socket(self):
+        super(_RPCClient, self)._reconnect_socket()
+        # Need to set a low HWM so sending package data doesn't overload
+        # the server. The socket is replaced after a timeout, so it's set
+        # again each time.
+        self.socket.set_hwm(10)
+
+
+class _ClientPool(object):
+    """
+    RPC clients for one Tansit endpoint, shared by every TansitPublisher in
+    the process. A ZeroMQ socket can only be used by one thread at a time,
+    so each caller checks a client out for as long as it needs it, and up to
+    max_clients calls can be made at once.
+    """
+
+    def __init__(self, endpoint, max_clients):
+        self.endpoint = endpoint
+        self._free = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_clients)
+
+    def _connect(self):
+        return _RPCClient(self.endpoint, timeout=RPC_TIMEOUT)
+
+    @contextmanager
+    def client(self):
+        with self._slots:
+            with self._lock:
+                client = self._free.pop() if self._free else None
+            if client is None:
+                client = self._connect()
+            try:
+                yield client
+            finally:
+                with self._lock:
+                    self._free.append(client)
+
+
+_client_pools = {}
+_client_pools_lock = threading.Lock()
+
+
+def _client_pool(endpoint, max_clients):
+    with _client_pools_lock:
+        if endpoint not in _client_pools:
+            _client_pools[endpoint] = _ClientPool(endpoint, max_clients)
+        return _client_pools[endpoint]
+
 
 class TansitPublisher(Publisher):
 
@@ -26,26 +125,40 @@ class TansitPublisher(Publisher):
         except KeyError:
             raise Exception("Tansit must be configured with an endpoint")
 
-        # FIXME: Set timeout per-request when that lands in jsonrpc2_zeromq
-        self._client = RPCNotifierClient(endpoint, timeout=120*1000)
-        # Need to set a low HWM so sending package data
-        # doesn't overload server
-        self._client.socket.set_hwm(10)
+        self._pool = _client_pool(
+            endpoint, self.config.get('connections', DEFAULT_CONNECTIONS))
 
     def list(self, repo, codename, component, arch):
-        return self._client.long_list(bucket=repo['bucket'], codename=codename,
-                                      component=component, arch=arch)
+        with self._pool.client() as client:
+            return client.long_list(bucket=repo['bucket'], codename=codename,
+                                    component=component, arch=arch)
 
     def copy(self, repo, packager, from_codename, from_component,
              to_codename, to_component, versions):
-        print(self._client.copy(
-            package=packager.name, to_codename=to_codename,
-            to_component=to_component, codename=from_codename,
-            component=from_component, versions=versions,
-            cache_control=DEFAULT_CACHE_CONTROL, preserve_versions=True,
-            bucket=repo['bucket'], arch=packager.arch))
+        with self._pool.client() as client:
+            print(client.copy(
+                package=packager.name, to_codename=to_codename,
+                to_component=to_component, codename=from_codename,
+                component=from_component, versions=versions,
+                cache_control=DEFAULT_CACHE_CONTROL, preserve_versions=True,
+                bucket=repo['bucket'], arch=packager.arch))
 
     def upload(self, repo, packager, codename, component):
+        # The package data and the upload call that refers to it go over
+        # the same connection
+        with self._pool.client() as client:
+            if self.config.get('data_endpoint'):
+                package_sha256 = self._stream_package(client, packager)
+            else:
+                package_sha256 = self._send_package(client, packager)
+
+            print(client.upload(
+                file_name=os.path.basename(packager.path),
+                file_sha256_hash=package_sha256, bucket=repo['bucket'],
+                codename=codename, component=component,
+                cache_control=DEFAULT_CACHE_CONTROL, preserve_versions=True))
+
+    def _send_package(self, client, packager):
         first_chunk = True
         package_hash = hashlib.sha256()
         package_filename = os.path.basename(packager.path)
@@ -58,15 +171,95 @@ class TansitPublisher(Publisher):
                     print(".")
                     break
                 package_hash.update(chunk)
-                self._client.send_package_data(file_name=package_filename,
-                                               data=urlsafe_b64encode(chunk),
-                                               new_file=first_chunk)
+                client.send_package_data(file_name=package_filename,
+                                         data=urlsafe_b64encode(chunk),
+                                         new_file=first_chunk)
                 print(".", end="")
                 sys.stdout.flush()
                 first_chunk = False
+        return package_hash.hexdigest()
 
-        print(self._client.upload(
-            file_name=package_filename,
-            file_sha256_hash=package_hash.hexdigest(), bucket=repo['bucket'],
-            codename=codename, component=component,
-            cache_control=DEFAULT_CACHE_CONTROL, preserve_versions=True))
+    def _stream_package(self, client, packager):
+        """
+        Sends the package as raw binary frames over the data_endpoint
+        socket, as described at the top of this module. The file is hashed
+        on another thread while it's sent.
+        """
+        file_name = os.path.basename(packager.path)
+        size = os.path.getsize(packager.path)
+        n_chunks = max(1, -(-size // BINARY_CHUNK_SIZE))
+        retries = self.config.get('upload_retries', DEFAULT_UPLOAD_RETRIES)
+        package_hash = hashlib.sha256()
+
+        def hash_package():
+            with open(packager.path, 'rb') as f:
+                for data in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+                    package_hash.update(data)
+
+        hasher = threading.Thread(target=hash_package)
+        hasher.start()
+
+        print("Uploading {} ({} chunks)".format(file_name, n_chunks))
+        started = time.time()
+        start = 0
+        try:
+            with open(packager.path, 'rb') as f:
+                while True:
+                    try:
+                        self._send_chunks(client, f, file_name, start,
+                                          n_chunks)
+                        break
+                    except _AckTimeout as e:
+                        if retries <= 0:
+                            raise Exception(
+                                "Timed out uploading {} at chunk {}".
+                                format(file_name, e.args[0]))
+                        retries -= 1
+                        start = client.package_data_received(
+                            file_name=file_name)
+                        print("Timed out waiting for the server; "
+                              "resuming from chunk {}".format(start))
+        finally:
+            hasher.join()
+
+        elapsed = max(time.time() - started, 0.001)
+        print("Uploaded {} MiB in {:.1f}s ({:.1f} MiB/s)".format(
+            size // (1024 * 1024), elapsed, size / elapsed / (1024 * 1024)))
+        return package_hash.hexdigest()
+
+    def _send_chunks(self, client, f, file_name, start, n_chunks):
+        window = self.config.get('upload_window', DEFAULT_UPLOAD_WINDOW)
+        ack_timeout = self.config.get('ack_timeout', DEFAULT_ACK_TIMEOUT)
+        socket = client.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.SNDHWM, window)
+        socket.connect(self.config['data_endpoint'])
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        try:
+            next_chunk = acked = start
+            while acked < n_chunks:
+                while next_chunk < n_chunks and next_chunk - acked < window:
+                    f.seek(next_chunk * BINARY_CHUNK_SIZE)
+                    header = json.dumps({'file_name': file_name,
+                                         'chunk': next_chunk,
+                                         'new_file': next_chunk == 0})
+                    socket.send_multipart(
+                        [PACKAGE_DATA_FRAME, header,
+                         f.read(BINARY_CHUNK_SIZE)], copy=False)
+                    next_chunk += 1
+                if not poller.poll(ack_timeout):
+                    raise _AckTimeout(acked)
+                frame, header = socket.recv_multipart()
+                ack = json.loads(header)
+                if frame == PACKAGE_DATA_ACK_FRAME and \
+                        ack.get('file_name') == file_name:
+                    if not acked - 1 <= ack['chunk'] < next_chunk:
+                        raise Exception(
+                            "Tansit acknowledged chunk {} of {} when chunks "
+                            "{} to {} were unacknowledged".format(
+                                ack['chunk'], file_name, acked,
+                                next_chunk - 1))
+                    acked = ack['chunk'] + 1
+        finally:
+            socket.close()
@@ -0,0 +1,126 @@
+# coding: utf-8
+
+"""
+Runs several jobs from one metallus.yml at the same time.
+
+Jobs are ordered by the packages they need: a job whose build_depends (or
+explicit depends_on list) names a package built by another job, or that
+other job itself, will only start once that job has finished successfully.
+Everything else is run as soon as a worker is free.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import re
+import sys
+import threading
+import traceback
+
+_PACKAGE_NAME_PATTERN = re.compile(r"\A\s*([^\s=<>(]+)")
+
+
+class JobCycleError(Exception):
+    pass
+
+
+class DependencyFailedError(Exception):
+    def __init__(self, job_name, failed):
+        self.job_name = job_name
+        self.failed = failed
+
+    def __str__(self):
+        return "{} not run; depends on failed job(s) {}".format(
+            self.job_name, ", ".join(sorted(self.failed)))
+
+
+def _package_name(spec):
+    if isinstance(spec, dict):
+        spec = spec.get('name', '')
+    m = _PACKAGE_NAME_PATTERN.match(spec)
+    return m.group(1) if m else None
+
+
+def job_dependencies(jobs):
+    """Maps each job name to the set of job names it has to wait for."""
+    producers = {}
+    for job in jobs:
+        producers[job.name] = job.name
+        for p in job.packages:
+            producers[p['name']] = job.name
+
+    out = {}
+    for job in jobs:
+        wanted = set(job.depends_on)
+        wanted.update(_package_name(d) for d in job.build_depends)
+        out[job.name] = set(producers[w] for w in wanted
+                            if w in producers and producers[w] != job.name)
+    return out
+
+
+def _check_for_cycles(dependencies):
+    done = set()
+    remaining = dict((k, set(v)) for k, v in dependencies.iteritems())
+    while remaining:
+        ready = [k for k, v in remaining.iteritems() if v <= done]
+        if not ready:
+            raise JobCycleError("dependency cycle between jobs: {}".format(
+                ", ".join(sorted(remaining))))
+        for k in ready:
+            done.add(k)
+            del remaining[k]
+
+
+class JobScheduler(object):
+
+    def __init__(self, jobs, workers):
+        self.dependencies = job_dependencies(jobs)
+        self.workers = max(1, workers)
+        _check_for_cycles(self.dependencies)
+
+    def run(self, fn):
+        """
+        Calls fn(job_name) for every job, in dependency order, with up to
+        self.workers calls in flight at once. Returns a dict of job name to
+        the exception it failed with, or None if it succeeded.
+        """
+        pending = dict((k, set(v)) for k, v in self.dependencies.iteritems())
+        running = set()
+        results = {}
+        cond = threading.Condition()
+
+        def worker(name):
+            error = None
+            try:
+                fn(name)
+            except (Exception, SystemExit) as e:
+                print("job {} failed:".format(name))
+                traceback.print_exc()
+                sys.stdout.flush()
+                error = e
+            with cond:
+                results[name] = error
+                running.discard(name)
+                cond.notify_all()
+
+        with cond:
+            while pending or running:
+                for name, deps in sorted(pending.items()):
+                    failed = set(d for d in deps
+                                 if d in results and results[d] is not None)
+                    if failed:
+                        results[name] = DependencyFailedError(name, failed)
+                        print(results[name])
+                        del pending[name]
+                        continue
+                    if len(running) < self.workers and \
+                            all(d in results for d in deps):
+                        del pending[name]
+                        running.add(name)
+                        print("Starting job {}".format(name))
+                        t = threading.Thread(target=worker, args=(name,))
+                        t.daemon = True
+                        t.start()
+                if running:
+                    cond.wait()
+        return results
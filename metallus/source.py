@@ -1,8 +1,14 @@
 # coding: utf-8
 
+import bisect
+import errno
+import json
+import os
 from os import path
 import re
-from fnmatch import fnmatch
+from fnmatch import translate
+import tempfile
+import threading
 import urlparse
 
 import git
@@ -14,23 +20,120 @@ CI_SKIP_PATTERN = re.compile(r"(?<!\\)\[ci skip\]", re.IGNORECASE)
 CI_SKIP_TESTS_PATTERN = re.compile(r"(?<!\\)\[ci skip([-_\s]tests)?\]",
                                    re.IGNORECASE)
 MAX_COMMIT_LOG = 50
-
-
-def _changed_paths(diffs):
-    def gen():
-        for d in diffs:
-            if d.a_blob:
-                yield d.a_blob.path
-            if d.b_blob:
-                yield d.b_blob.path
-    return set(gen())
-
-
-def _path_is_prefix(prefix, p):
-    if prefix.endswith('/'):
-        return p.startswith(prefix)
-    else:
-        return fnmatch(p, prefix)
+# Most commits looked at to count them or check for skip commands
+MAX_COMMIT_WALK = 1000
+
+# Mirrors already fetched by this process; all jobs checked out in one run
+# share a single fetch from the remote.
+_fetched_mirrors = set()
+_mirrors_lock = threading.Lock()
+
+
+def _glob_literal_prefix(pattern):
+    """The part of an fnmatch pattern before its first wildcard."""
+    m = re.search(r"[*?[]", pattern)
+    return pattern[:m.start()] if m else pattern
+
+
+def _compile_path_patterns(patterns):
+    """
+    Compiles path patterns into a single regex to be used with match().
+    Patterns ending in a slash match paths they are a prefix of; anything
+    else is an fnmatch glob.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(
+        "(?:{})".format(re.escape(p) if p.endswith('/') else translate(p))
+        for p in patterns))
+
+
+class ChangedPaths(object):
+    """
+    Sorted set of paths changed since the last successful build. Prefix
+    patterns, and the literal start of glob patterns, are looked up by
+    bisection so only the paths that could match are ever scanned.
+    """
+
+    def __init__(self, paths):
+        self.paths = sorted(set(paths))
+
+    def __contains__(self, p):
+        i = bisect.bisect_left(self.paths, p)
+        return i < len(self.paths) and self.paths[i] == p
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _with_prefix(self, prefix):
+        for i in xrange(bisect.bisect_left(self.paths, prefix),
+                        len(self.paths)):
+            if not self.paths[i].startswith(prefix):
+                break
+            yield self.paths[i]
+
+    def matching(self, patterns):
+        for pattern in patterns:
+            if pattern.endswith('/'):
+                for p in self._with_prefix(pattern):
+                    yield p
+            else:
+                regex = _compile_path_patterns([pattern])
+                for p in self._with_prefix(_glob_literal_prefix(pattern)):
+                    if regex.match(p):
+                        yield p
+
+    def has_changes(self, include, exclude=None):
+        exclude_regex = _compile_path_patterns(exclude)
+        return any(exclude_regex is None or not exclude_regex.match(p)
+                   for p in self.matching(include))
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn) as f:
+            data = json.load(f)
+        return data['head'], cls(data['paths'])
+
+    def save(self, fn, head):
+        d = path.dirname(fn)
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            if not e.errno == errno.EEXIST:
+                raise
+        # Write then rename, as other jobs on the branch may read it at
+        # the same time
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'head': head, 'paths': self.paths}, f)
+        os.rename(tmp, fn)
+
+
+def fetch_mirror(url, fn):
+    """
+    Returns the path to a bare mirror of url kept under fn, cloning it if
+    it's not there yet and fetching it at most once per process.
+
+    Checkouts are cloned with --shared from the mirror, so they borrow its
+    objects rather than having their own copy. Pruning of unreachable
+    objects is switched off in the mirror so that a force-push can't remove
+    objects those checkouts still refer to.
+    """
+    mirror_path = path.join(fn, "mirrors", utils.sha256(url) + ".git")
+    with _mirrors_lock:
+        if mirror_path in _fetched_mirrors:
+            return mirror_path
+        if not path.isdir(path.dirname(mirror_path)):
+            os.makedirs(path.dirname(mirror_path))
+        with utils.file_lock(mirror_path + ".lock"):
+            if path.isdir(mirror_path):
+                git.Repo(mirror_path).remotes.origin.fetch()
+            else:
+                mirror = git.Repo.clone_from(url, mirror_path, mirror=True)
+                with mirror.config_writer() as cw:
+                    cw.set_value("gc", "pruneExpire", "never")
+        _fetched_mirrors.add(mirror_path)
+    return mirror_path
 
 
 class Git(object):
@@ -40,6 +143,7 @@ class Git(object):
 
     def __init__(self, url, fn, branch, job):
         self._path = path.join(fn, "src", branch, job)
+        self.project_path = fn
         self.url = url
         self._repo = None
         self._changed_paths = None
@@ -76,10 +180,8 @@ class Git(object):
         elif self._changed_paths:
             if 'metallus.yml' in self._changed_paths:
                 return True
-            return any((_path_is_prefix(root, p) or
-                        any(_path_is_prefix(q, p) for q in include or [])) and
-                       all(not _path_is_prefix(r, p) for r in exclude or [])
-                       for p in self._changed_paths)
+            return self._changed_paths.has_changes([root] + (include or []),
+                                                   exclude)
         else:
             return False
 
@@ -93,16 +195,21 @@ class Git(object):
         self.num_commits = 0
         self.current_branch = branch
 
+        mirror_path = fetch_mirror(self.url, self.project_path)
         if path.isdir(path.join(self.path, ".git")):
             self._repo = git.Repo(self.path)
             self._changed_paths = None
         else:
-            self._repo = git.Repo.clone_from(self.url, self.path + "/",
-                                             recursive=True)
+            self._repo = git.Repo.clone_from(mirror_path, self.path + "/",
+                                             shared=True)
+            # Point origin back at the real remote so that relative
+            # submodule URLs and builders reading `git remote` still work
+            with self._repo.remotes.origin.config_writer as cw:
+                cw.set("url", self.url)
             self._changed_paths = True  # "everything"
         repo = self._repo
 
-        repo.remotes.origin.fetch()
+        repo.git.fetch(mirror_path, "+refs/heads/*:refs/remotes/origin/*")
 
         repo.head.reset(index=True, working_tree=True)
         new_ref = getattr(repo.branches, branch, None)
@@ -117,29 +224,91 @@ class Git(object):
                               force_reset=True)
 
         last_build_tag = getattr(repo.tags, self.last_build_tag_name, None)
-        last_successful_commit = (last_build_tag.commit if last_build_tag
-                                  else Git.EMPTY_TREE_HASH)
-
-        self._changed_paths = _changed_paths(
-            repo.head.commit.diff(last_successful_commit))
-        commits = list(self._iter_commits_until(last_successful_commit))
-        self.num_commits = len(commits)
-        self.commits = commits
-        self.skip_all = all(CI_SKIP_PATTERN.search(c.summary)
-                            for c in commits)
-        self.skip_tests = all(CI_SKIP_TESTS_PATTERN.search(c.summary)
-                              for c in commits)
+        if last_build_tag:
+            last_successful_commit = last_build_tag.commit.hexsha
+            # Also right when the tag isn't an ancestor after a force-push:
+            # only commits not reachable from it are walked
+            rev = "{}..HEAD".format(last_successful_commit)
+        else:
+            last_successful_commit = Git.EMPTY_TREE_HASH
+            rev = "HEAD"
+
+        self._changed_paths = self._load_changed_paths(last_successful_commit)
+        self.num_commits = int(repo.git.rev_list(
+            rev, count=True, max_count=MAX_COMMIT_WALK))
+        # Commit objects are lazy, so only the ones logged get read
+        self.commits = list(repo.iter_commits(rev, max_count=MAX_COMMIT_LOG))
+        self.skip_all, self.skip_tests = self._scan_skip_commands(rev)
         if len(self.commits) > 0:
             self.author = self.commits[0].author
         else:
             self.author = ""
 
+    def _scan_skip_commands(self, rev):
+        """
+        Returns whether every commit in rev asks for the build, or just the
+        tests, to be skipped. Stops at the first commit that asks for
+        neither; if MAX_COMMIT_WALK commits go by without finding one, errs
+        on the side of building and testing.
+        """
+        skip_all = True
+        n = 0
+        for n, c in enumerate(self._repo.iter_commits(
+                rev, max_count=MAX_COMMIT_WALK), 1):
+            summary = c.summary
+            # [ci skip] matches this too, so neither can be set after here
+            if not CI_SKIP_TESTS_PATTERN.search(summary):
+                return False, False
+            skip_all = skip_all and bool(CI_SKIP_PATTERN.search(summary))
+        if n >= MAX_COMMIT_WALK:
+            return False, False
+        return skip_all, True
+
+    def _changed_paths_index_path(self, base):
+        return path.join(self.project_path, "changes",
+                         utils.sha256(self.current_branch), base + ".json")
+
+    def _diff_paths(self, base, head):
+        if base == Git.EMPTY_TREE_HASH:
+            out = self._repo.git.ls_tree("-r", "--name-only", "-z", head)
+        else:
+            out = self._repo.git.diff("--name-only", "--no-renames", "-z",
+                                      base, head)
+        return [p for p in out.split("\0") if p]
+
+    def _load_changed_paths(self, base):
+        """
+        Paths changed between base and HEAD. These are kept on disk per
+        branch and base commit, so the next build from the same base only
+        has to diff the commits that have been pulled since. That gives a
+        superset of a straight diff, as files changed and then changed back
+        are still counted, which errs on the side of building.
+        """
+        head = self.hash
+        fn = self._changed_paths_index_path(base)
+        paths = None
+        try:
+            cached_head, cached = ChangedPaths.load(fn)
+        except (IOError, ValueError, KeyError):
+            pass
+        else:
+            if cached_head == head:
+                return cached
+            try:
+                if self._repo.is_ancestor(cached_head, head):
+                    paths = cached.paths + self._diff_paths(cached_head,
+                                                            head)
+            except git.GitCommandError:
+                pass  # cached head has gone, e.g. after a force-push
+        if paths is None:
+            paths = self._diff_paths(base, head)
+
+        changed = ChangedPaths(paths)
+        changed.save(fn, head)
+        return changed
+
     def log_commits(self):
-        r = list(self.commits)
-        l = len(r)
-        if l > MAX_COMMIT_LOG:
-            return (r[0:MAX_COMMIT_LOG], True)
-        return (r, False)
+        return (list(self.commits), self.num_commits > MAX_COMMIT_LOG)
 
     def format_commits(self):
         def mklink(c):
@@ -163,9 +332,3 @@ class Git(object):
 
     def tag_success(self):
         self._repo.create_tag(self.last_build_tag_name, force=True)
-
-    def _iter_commits_until(self, until_commit):
-        for c in self._repo.iter_commits():
-            if c == until_commit:
-                break
-            yield c
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+from cStringIO import StringIO
+import gzip
+import hashlib
+import os
+from os import path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from metallus.debian import DebianPackage, iter_packages_index, \
+    gunzip_chunks
+
+INDEX = """Package: app1
+Version: 1.0-1
+Architecture: amd64
+Git-Commit-Id: 0123abcd
+Filename: pool/main/a/app1/app1_1.0-1_amd64.deb
+SHA256: 9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08
+Description: the first app
+ It does things.
+ .
+ Lots of things.
+
+Package: app2
+Version: 2.0
+Depends: app1 (>= 1.0)
+
+
+Package: app3
+Version: 3:3.0
+"""
+
+EXPECTED = [
+    {
+        'Package': "app1",
+        'Version': "1.0-1",
+        'Architecture': "amd64",
+        'Git-Commit-Id': "0123abcd",
+        'Filename': "pool/main/a/app1/app1_1.0-1_amd64.deb",
+        'SHA256': "9f86d081884c7d659a2feaa0c55ad015"
+                  "a3bf4f1b2b0b822cd15d6c15b0f00a08",
+        'Description': "the first app\nIt does things.\n.\nLots of things.",
+    },
+    {'Package': "app2", 'Version': "2.0", 'Depends': "app1 (>= 1.0)"},
+    {'Package': "app3", 'Version': "3:3.0"},
+]
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def _gzip(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class TestIterPackagesIndex(unittest.TestCase):
+
+    def test_single_chunk(self):
+        self.assertEqual(EXPECTED, list(iter_packages_index([INDEX])))
+
+    def test_every_chunk_size(self):
+        for size in xrange(1, len(INDEX) + 1):
+            self.assertEqual(EXPECTED, list(iter_packages_index(
+                _chunks(INDEX, size))), "chunk size {}".format(size))
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(EXPECTED, list(iter_packages_index(
+            _chunks(INDEX.rstrip("\n"), 7))))
+
+    def test_yields_stanzas_as_they_are_read(self):
+        def chunks():
+            yield INDEX[:INDEX.index("Package: app2")]
+            self.fail("read past the first stanza")
+        self.assertEqual(EXPECTED[0], next(iter_packages_index(chunks())))
+
+    def test_empty(self):
+        self.assertEqual([], list(iter_packages_index([])))
+        self.assertEqual([], list(iter_packages_index(["\n\n"])))
+
+    def test_gzipped_across_chunk_boundaries(self):
+        compressed = _gzip(INDEX)
+        for size in (1, 3, 10, 64, len(compressed)):
+            self.assertEqual(EXPECTED, list(iter_packages_index(
+                gunzip_chunks(_chunks(compressed, size)))),
+                "chunk size {}".format(size))
+
+
+def _ar_members(fn):
+    members = {}
+    with open(fn, 'rb') as f:
+        f.read(8)
+        while True:
+            header = f.read(60)
+            if not header:
+                return members
+            size = int(header[48:58])
+            members[header[:16].strip()] = f.read(size)
+            f.read(size % 2)
+
+
+class TestDebianPackage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = path.join(self.directory, "root")
+        for d in ("usr/bin", "etc/app1"):
+            os.makedirs(path.join(self.root, d))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _control_file(self, members, name):
+        with tarfile.open(fileobj=StringIO(members["control.tar.gz"])) as tar:
+            return tar.extractfile("./" + name).read()
+
+    def test_hard_links_have_md5sums(self):
+        with open(path.join(self.root, "usr/bin/app1"), 'wb') as f:
+            f.write("#!/bin/sh\n")
+        with open(path.join(self.root, "etc/app1/app1.conf"), 'wb') as f:
+            f.write("a = 1\n")
+        os.link(path.join(self.root, "usr/bin/app1"),
+                path.join(self.root, "usr/bin/app1-link"))
+        os.link(path.join(self.root, "etc/app1/app1.conf"),
+                path.join(self.root, "etc/app1/default.conf"))
+
+        fn = path.join(self.directory, "app1.deb")
+        DebianPackage("app1", "1.0", "amd64").write(self.root, fn)
+        members = _ar_members(fn)
+
+        app1 = hashlib.md5("#!/bin/sh\n").hexdigest()
+        conf = hashlib.md5("a = 1\n").hexdigest()
+        self.assertEqual(
+            "{0}  etc/app1/app1.conf\n{0}  etc/app1/default.conf\n"
+            "{1}  usr/bin/app1\n{1}  usr/bin/app1-link\n".format(conf, app1),
+            self._control_file(members, "md5sums"))
+        self.assertEqual("/etc/app1/app1.conf\n/etc/app1/default.conf\n",
+                         self._control_file(members, "conffiles"))
+        with tarfile.open(fileobj=StringIO(members["data.tar.gz"])) as tar:
+            self.assertTrue(tar.getmember("./usr/bin/app1-link").islnk())
@@ -0,0 +1,107 @@
+# coding: utf-8
+
+from os import path
+import shutil
+import tempfile
+import unittest
+
+from metallus.source import ChangedPaths, _compile_path_patterns, \
+    _glob_literal_prefix
+
+PATHS = [
+    "ab",
+    "a/c",
+    "a/b",
+    "a/bc",
+    "a/b/c",
+    "docs/index.md",
+    "docs/api/index.md",
+    "src/app.py",
+    "src/app.py",
+]
+
+
+class TestPathPatterns(unittest.TestCase):
+
+    def test_no_patterns(self):
+        self.assertIsNone(_compile_path_patterns(None))
+        self.assertIsNone(_compile_path_patterns([]))
+
+    def test_prefix_patterns_are_literal(self):
+        regex = _compile_path_patterns(["a.b/"])
+        self.assertTrue(regex.match("a.b/c"))
+        self.assertFalse(regex.match("axb/c"))
+        self.assertFalse(regex.match("a.b"))
+
+    def test_globs(self):
+        regex = _compile_path_patterns(["docs/*.md", "src/?.py"])
+        self.assertTrue(regex.match("docs/index.md"))
+        self.assertTrue(regex.match("src/a.py"))
+        self.assertFalse(regex.match("src/ab.py"))
+        self.assertFalse(regex.match("docs/index.txt"))
+
+    def test_globs_match_whole_paths(self):
+        regex = _compile_path_patterns(["*.py", "src/"])
+        self.assertTrue(regex.match("setup.py"))
+        self.assertTrue(regex.match("src/app.py"))
+        self.assertFalse(regex.match("setup.pyc"))
+
+    def test_glob_literal_prefix(self):
+        self.assertEqual("docs/", _glob_literal_prefix("docs/*.md"))
+        self.assertEqual("src/a", _glob_literal_prefix("src/a?.py"))
+        self.assertEqual("lib/", _glob_literal_prefix("lib/[ab]/x"))
+        self.assertEqual("", _glob_literal_prefix("*.py"))
+        self.assertEqual("README.md", _glob_literal_prefix("README.md"))
+
+
+class TestChangedPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.changed = ChangedPaths(PATHS)
+
+    def test_sorted_without_duplicates(self):
+        self.assertEqual(sorted(set(PATHS)), self.changed.paths)
+        self.assertEqual(8, len(self.changed))
+
+    def test_contains(self):
+        self.assertIn("a/b", self.changed)
+        self.assertIn("src/app.py", self.changed)
+        self.assertNotIn("a", self.changed)
+        self.assertNotIn("zzz", self.changed)
+
+    def test_with_prefix_stops_at_end_of_range(self):
+        self.assertEqual(["a/b", "a/b/c", "a/bc"],
+                         list(self.changed._with_prefix("a/b")))
+        self.assertEqual(["a/b/c"], list(self.changed._with_prefix("a/b/")))
+        self.assertEqual([], list(self.changed._with_prefix("b")))
+        self.assertEqual([], list(self.changed._with_prefix("zzz")))
+        self.assertEqual(self.changed.paths,
+                         list(self.changed._with_prefix("")))
+
+    def test_matching(self):
+        self.assertEqual(["a/b/c"], list(self.changed.matching(["a/b/"])))
+        self.assertEqual(["a/b/c", "a/bc"],
+                         list(self.changed.matching(["a/b?*"])))
+        self.assertEqual(["docs/api/index.md", "docs/index.md"],
+                         list(self.changed.matching(["docs/*.md"])))
+        self.assertEqual(["src/app.py"], list(self.changed.matching(["*.py"])))
+        self.assertEqual([], list(self.changed.matching(["lib/"])))
+
+    def test_has_changes(self):
+        self.assertTrue(self.changed.has_changes(["src/"]))
+        self.assertFalse(self.changed.has_changes(["lib/"]))
+        self.assertFalse(self.changed.has_changes(["docs/"], ["*.md"]))
+        self.assertTrue(self.changed.has_changes(["docs/", "a/"], ["*.md"]))
+        self.assertTrue(self.changed.has_changes(["docs/"],
+                                                 ["docs/api/"]))
+
+    def test_save_and_load(self):
+        d = tempfile.mkdtemp()
+        try:
+            fn = path.join(d, "branch", "changed.json")
+            self.changed.save(fn, "abc123")
+            head, loaded = ChangedPaths.load(fn)
+            self.assertEqual("abc123", head)
+            self.assertEqual(self.changed.paths, loaded.paths)
+        finally:
+            shutil.rmtree(d)
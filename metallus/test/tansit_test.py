@@ -0,0 +1,252 @@
+# coding: utf-8
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from jsonrpc2_zeromq import RPCNotificationServer
+import mock
+import zmq
+
+from metallus.publishers import tansit
+from metallus.publishers.tansit import TansitPublisher, \
+    PACKAGE_DATA_FRAME, PACKAGE_DATA_ACK_FRAME
+
+CHUNK_SIZE = 1000
+CONNECTIONS = 2
+
+
+class FakeRPCServer(RPCNotificationServer):
+    """
+    A Tansit RPC endpoint, which records the calls made and the client
+    each came from, and takes a moment over each so they pile up.
+    """
+
+    def __init__(self, endpoint):
+        super(FakeRPCServer, self).__init__(endpoint, timeout=50)
+        self.calls = []
+        self.clients = set()
+
+    def _handle_method_and_response(self, client_id, req):
+        self.clients.add(client_id)
+        super(FakeRPCServer, self)._handle_method_and_response(client_id,
+                                                               req)
+
+    def handle_long_list_method(self, bucket, codename, component, arch):
+        time.sleep(0.01)
+        self.calls.append(('long_list', bucket))
+        return [{'Package': "app1", 'Version': "1.0"}]
+
+    def handle_copy_method(self, bucket, **kwargs):
+        time.sleep(0.01)
+        self.calls.append(('copy', bucket))
+        return "copied"
+
+
+class FakeDataServer(object):
+    """
+    A Tansit data endpoint on a ROUTER socket, which keeps the chunks it's
+    sent and acks every ack_every'th one, and the last. Chunks for which
+    drop(chunk) is true are thrown away, as if lost.
+    """
+
+    def __init__(self, context, n_chunks, ack_every=1, drop=None,
+                 ack_for=None):
+        self.n_chunks = n_chunks
+        self.ack_every = ack_every
+        self.drop = drop or (lambda chunk: False)
+        self.ack_for = ack_for or (lambda chunk: chunk)
+        self.chunks = {}
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        port = self.socket.bind_to_random_port("tcp://127.0.0.1")
+        self.endpoint = "tcp://127.0.0.1:{}".format(port)
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def received(self):
+        """Chunks held without a gap, as package_data_received gives."""
+        n = 0
+        while n in self.chunks:
+            n += 1
+        return n
+
+    def data(self):
+        return "".join(self.chunks[i] for i in xrange(self.received()))
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        self.socket.close()
+
+    def _serve(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            if not poller.poll(50):
+                continue
+            identity, frame, header, data = self.socket.recv_multipart()
+            assert frame == PACKAGE_DATA_FRAME
+            header = json.loads(header)
+            chunk = header['chunk']
+            if self.drop(chunk):
+                continue
+            if chunk != self.received():
+                # Out of order after a lost chunk; wait for the resend
+                continue
+            self.chunks[chunk] = data
+            if (chunk + 1) % self.ack_every == 0 or \
+                    chunk == self.n_chunks - 1:
+                self.socket.send_multipart([
+                    identity, PACKAGE_DATA_ACK_FRAME,
+                    json.dumps({'file_name': header['file_name'],
+                                'chunk': self.ack_for(chunk)})])
+
+
+def _first_time(chunk):
+    """Drops chunk the first time it's sent."""
+    sent = []
+
+    def drop(c):
+        sent.append(c)
+        return c == chunk and sent.count(c) == 1
+    return drop
+
+
+class TestTansitStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        fd, self.path = tempfile.mkstemp(suffix=".deb")
+        self.contents = os.urandom(CHUNK_SIZE * 5 + 123)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.contents)
+        self.packager = mock.Mock(path=self.path)
+        patcher = mock.patch.object(tansit, 'BINARY_CHUNK_SIZE', CHUNK_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        self.context.term()
+        os.remove(self.path)
+
+    def _stream(self, **server_args):
+        self.server = FakeDataServer(self.context, 6, **server_args)
+        publisher = TansitPublisher(
+            endpoint="tcp://127.0.0.1:1", data_endpoint=self.server.endpoint,
+            upload_window=3, ack_timeout=200, upload_retries=2)
+        client = mock.Mock(context=self.context)
+        client.package_data_received.side_effect = \
+            lambda file_name: self.server.received()
+        return publisher._stream_package(client, self.packager), client
+
+    def test_every_chunk_acked(self):
+        package_sha256, client = self._stream()
+        self.assertEqual(self.contents, self.server.data())
+        self.assertEqual(hashlib.sha256(self.contents).hexdigest(),
+                         package_sha256)
+        self.assertFalse(client.package_data_received.called)
+
+    def test_cumulative_acks(self):
+        package_sha256, client = self._stream(ack_every=3)
+        self.assertEqual(self.contents, self.server.data())
+        self.assertFalse(client.package_data_received.called)
+
+    def test_resumes_after_lost_chunk(self):
+        package_sha256, client = self._stream(drop=_first_time(2))
+        self.assertEqual(self.contents, self.server.data())
+        self.assertEqual(hashlib.sha256(self.contents).hexdigest(),
+                         package_sha256)
+        client.package_data_received.assert_called_once_with(
+            file_name=os.path.basename(self.path))
+
+    def test_gives_up_after_retries(self):
+        with self.assertRaisesRegexp(Exception, "Timed out uploading"):
+            self._stream(drop=lambda chunk: chunk == 2)
+
+    def test_ack_for_unsent_chunk(self):
+        with self.assertRaisesRegexp(Exception, "acknowledged chunk 5"):
+            self._stream(ack_for=lambda chunk: 5)
+
+
+class TestTansitClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.endpoint = "ipc://" + os.path.join(self.directory, "rpc")
+        patcher = mock.patch.object(tansit, 'RPC_TIMEOUT', 5000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = FakeRPCServer(self.endpoint)
+        self.server.start()
+        self.publishers = [TansitPublisher(endpoint=self.endpoint,
+                                           connections=CONNECTIONS)
+                           for _ in xrange(2)]
+        self.pool = self.publishers[0]._pool
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.join()
+        for client in self.pool._free:
+            client.socket.close()
+        tansit._client_pools.pop(self.endpoint, None)
+        self.server.socket.close()
+        shutil.rmtree(self.directory)
+
+    def _call(self, i):
+        publisher = self.publishers[i % 2]
+        repo = {'bucket': "bucket{}".format(i)}
+        if i % 3:
+            publisher.list(repo, "trusty", "main", "amd64")
+        else:
+            packager = mock.Mock(arch="amd64")
+            packager.name = "app1"
+            publisher.copy(repo, packager, "trusty", "main", "xenial", "main",
+                           ["1.0"])
+
+    def test_publishers_share_a_pool(self):
+        self.assertIs(self.pool, self.publishers[1]._pool)
+
+    def test_concurrent_calls_are_capped_and_reuse_clients(self):
+        errors = []
+
+        def call(i):
+            try:
+                self._call(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(i,))
+                   for i in xrange(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(sorted("bucket{}".format(i) for i in xrange(12)),
+                         sorted(bucket for _, bucket in self.server.calls))
+        self.assertLessEqual(len(self.server.clients), CONNECTIONS)
+        self.assertLessEqual(len(self.pool._free), CONNECTIONS)
+
+        clients = set(self.server.clients)
+        for i in xrange(4):
+            self._call(i)
+        self.assertEqual(clients, self.server.clients)
+
+    def test_hwm_kept_after_timeout(self):
+        with self.pool.client() as client:
+            socket = client.socket
+            self.assertEqual(10, socket.get_hwm())
+            client.on_timeout(None)
+            self.assertIsNot(socket, client.socket)
+            self.assertEqual(10, client.socket.get_hwm())
@@ -1,6 +1,18 @@
 # coding: utf-8
 
+import collections
+from contextlib import contextmanager
 import copy
+import errno
+import fcntl
+import glob
+import os
+import shutil
+import StringIO
+import sys
+import threading
+import time
+import uuid
 import yaml
 from os import path
 import hashlib
@@ -10,14 +22,14 @@ import docker.utils
 from . import defaults
 
 
-def new_docker_client():
+def new_docker_client(timeout=120):
     kwargs = docker.utils.kwargs_from_env()
     if len(kwargs.keys()) == 0:
         kwargs['base_url'] = "unix:///var/run/docker.sock"
     else:
         kwargs['tls'].assert_hostname = False
     kwargs['version'] = "1.19"
-    return docker.Client(timeout=120, **kwargs)
+    return docker.Client(timeout=timeout, **kwargs)
 
 
 def s3_host(region):
@@ -50,6 +62,141 @@ def sha256(val):
     return m.hexdigest()
 
 
+REAP_DIRECTORY_FORMAT = ".{name}.reap-{id}"
+
+
+def reap_in_background(paths):
+    def reap():
+        for p in paths:
+            shutil.rmtree(p, ignore_errors=True)
+    if paths:
+        t = threading.Thread(target=reap)
+        t.daemon = True
+        t.start()
+
+
+def fresh_directory(directory):
+    """
+    Gives directory a fresh, empty directory. The old one is renamed out of
+    the way and deleted in the background, along with any left behind by
+    earlier runs that exited before they were deleted.
+    """
+    parent, name = path.split(directory)
+    if path.isdir(directory):
+        os.rename(directory, path.join(
+            parent, REAP_DIRECTORY_FORMAT.format(name=name,
+                                                 id=uuid.uuid4().hex)))
+    os.makedirs(directory)
+    reap_in_background(glob.glob(path.join(
+        parent, REAP_DIRECTORY_FORMAT.format(name=name, id='*'))))
+
+
+LOCK_POLL_INTERVAL = 0.5
+
+# lockf locks belong to the process, so threads also need to take one of
+# these to keep each other out
+_thread_file_locks = collections.defaultdict(threading.Lock)
+_thread_file_locks_lock = threading.Lock()
+
+# Total seconds spent waiting for each lock file, for reporting
+lock_wait_seconds = collections.Counter()
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+def _try_lockf(f):
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+        return False
+
+
+def _wait_for(try_acquire, fn, deadline):
+    while not try_acquire():
+        if time.time() >= deadline:
+            raise LockTimeoutError("timed out waiting for lock {}".
+                                   format(fn))
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+@contextmanager
+def file_lock(fn, timeout=None):
+    """
+    Holds an exclusive lock on fn, against other processes and threads.
+    Raises LockTimeoutError if it's not acquired within timeout seconds,
+    when given.
+    """
+    with _thread_file_locks_lock:
+        thread_lock = _thread_file_locks[path.abspath(fn)]
+    started = time.time()
+    deadline = None if timeout is None else started + timeout
+    if deadline is None:
+        thread_lock.acquire()
+    else:
+        _wait_for(lambda: thread_lock.acquire(False), fn, deadline)
+    try:
+        with open(fn, 'w') as lock:
+            if deadline is None:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+            else:
+                _wait_for(lambda: _try_lockf(lock), fn, deadline)
+            lock_wait_seconds[fn] += time.time() - started
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+    finally:
+        thread_lock.release()
+
+
+class _ThreadLocalStdout(object):
+    """Sends writes to a buffer for threads capturing their output."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, s):
+        buf = getattr(self.local, 'buffer', None)
+        (self.stdout if buf is None else buf).write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+_stdout_lock = threading.Lock()
+
+
+@contextmanager
+def capture_output():
+    """
+    Collects what the current thread prints into a StringIO, which is
+    yielded. Output from subprocesses isn't captured.
+    """
+    with _stdout_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStdout):
+            sys.stdout = _ThreadLocalStdout(sys.stdout)
+        stdout = sys.stdout
+    buf = StringIO.StringIO()
+    stdout.local.buffer = buf
+    try:
+        yield buf
+    finally:
+        stdout.local.buffer = None
+
+
+def print_block(s):
+    """Prints s without output from other threads getting mixed in."""
+    with _stdout_lock:
+        sys.stdout.write(s)
+        sys.stdout.flush()
+
+
 def merge(a, b):
     '''recursively merges dict's. not just simple a['key'] = b['key'], if
     both a and bhave a key who's value is a dict then dict_merge is called